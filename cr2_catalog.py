@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import json
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
+import jbcatalog
+
+## main program
+
+def main():
+   # interpret user options
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-c", "--catalog", required=True,
+                     help="catalog database file (created if necessary)")
+   parser.add_argument("-u", "--update", action="append",
+                     help="scan directory tree for new, changed, or deleted raw files (may be repeated)")
+   parser.add_argument("-q", "--query", action="append",
+                     help="print catalog record for given raw file (may be repeated)")
+   parser.add_argument("-m", "--model",
+                     help="list raw files with given camera model")
+   parser.add_argument("-s", "--strip",
+                     help="list raw files containing a data strip with given SHA-1 hash")
+   parser.add_argument("-f", "--field", action="append",
+                     help="only print given field of each record (may be repeated)")
+   args = parser.parse_args()
+
+   # open catalog
+   db = jbcatalog.catalog(args.catalog)
+   errors = 0
+   # update with given directory trees
+   if args.update:
+      # keep parser messages out of the way
+      stdout = sys.stdout
+      sys.stdout = open(os.devnull, 'w')
+      try:
+         for root in args.update:
+            updated, unchanged, removed, failed = db.update(root)
+            for path, reason in failed:
+               print >> sys.stderr, "Cannot catalog %s: %s" % (path, reason)
+            print >> stdout, "%s: %d updated, %d unchanged, %d removed, %d failed" % \
+               (root, updated, unchanged, removed, len(failed))
+            errors += len(failed)
+      finally:
+         sys.stdout.close()
+         sys.stdout = stdout
+   # collect requested records
+   records = []
+   if args.query:
+      for path in args.query:
+         record = db.lookup(path)
+         if record is None:
+            print >> sys.stderr, "%s: not in catalog" % path
+            continue
+         records.append(record)
+   if args.model:
+      records += db.query(model=args.model)
+   if args.strip:
+      for path, k, i in db.find_strip(args.strip):
+         print "%s\tIFD#%d strip %d" % (path, k, i)
+   # print requested records
+   for record in records:
+      if args.field:
+         print '\t'.join([json.dumps(record[name]) for name in args.field])
+         continue
+      print record['path']
+      for name, sql_type in jbcatalog.catalog.fields[1:]:
+         print "   %s: %s" % (name, json.dumps(record[name]))
+   db.close()
+   if errors:
+      sys.exit(1)
+   return
+
+# main entry point
+if __name__ == '__main__':
+   main()
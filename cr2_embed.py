@@ -20,6 +20,7 @@
 
 import sys
 import os
+import shutil
 import argparse
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
@@ -35,25 +36,50 @@ def main():
                      help="input raw file to use as basis")
    parser.add_argument("-b", "--basename", required=True,
                      help="base filename for replacement components (appended with -x.dat for IFD# x)")
-   parser.add_argument("-o", "--output", required=True,
-                     help="output CR2 file")
+   parser.add_argument("-o", "--output",
+                     help="output CR2 file ('-' for standard output)")
+   parser.add_argument("-p", "--patch", action="store_true", default=False,
+                     help="patch replacement components into a copy of the input file, leaving everything else unchanged (in place, if no output file is given)")
    args = parser.parse_args()
+   if not args.output and not args.patch:
+      parser.error("an output file is required, unless patching in place")
+   if args.output == '-' and args.patch:
+      parser.error("cannot patch standard output")
 
-   # read input raw file
-   tiff = jbtiff.tiff_file(open(args.input, 'rb'))
+   # when writing to standard output, send messages to standard error
+   if args.output == '-':
+      sys.stdout = sys.stderr
+
+   # read input raw file, or the file to be patched
+   if args.patch:
+      if args.output:
+         shutil.copyfile(args.input, args.output)
+         fid = open(args.output, 'r+b')
+      else:
+         fid = open(args.input, 'r+b')
+   else:
+      fid = open(args.input, 'rb')
+   tiff = jbtiff.tiff_file(fid)
    # replace data strips where file exists
    for k in range(len(tiff.data)):
       # construct data filename and check it exists
       filename = '%s-%d.dat' % (args.basename, k)
       if not os.path.isfile(filename):
          continue
-      # read input data file
-      with open(filename, 'rb') as fid:
-         data = fid.read()
+      # map input data file where possible, to be copied directly when writing
+      data = jbtiff.tiff_file.read_strip(open(filename, 'rb'))
       # replace data strips with new data
-      jbcr2.replace_ifd(tiff, k, data)
-   # save updated CR2 file
-   tiff.write(open(args.output,'wb'))
+      if args.patch:
+         tiff.patch_strips(fid, k, data)
+      else:
+         jbcr2.replace_ifd(tiff, k, data)
+   # save updated CR2 file, unless it was patched
+   if args.patch:
+      fid.close()
+   elif args.output == '-':
+      tiff.write(sys.__stdout__)
+   else:
+      tiff.write_file(args.output)
    return
 
 # main entry point
@@ -36,10 +36,12 @@ def main():
                      help="output file basename for embedded data in IFDs")
    parser.add_argument("-d", "--display", action="store_true", default=False,
                      help="print read data")
+   parser.add_argument("-v", "--verify", action="store_true", default=False,
+                     help="check that bytes not used by any object are zero")
    args = parser.parse_args()
 
    # read input file
-   tiff = jbtiff.tiff_file(open(args.input, 'rb'))
+   tiff = jbtiff.tiff_file(open(args.input, 'rb'), verify=args.verify)
    # print data as needed
    if args.display:
       tiff.display(sys.stdout)
@@ -32,12 +32,24 @@ def main():
    parser = argparse.ArgumentParser()
    parser.add_argument("-i", "--input", required=True,
                      help="input raw file to analyse")
+   parser.add_argument("-q", "--query", action="append", type=lambda x: int(x,0),
+                     help="only list objects covering given offset (may be repeated)")
    args = parser.parse_args()
 
    # read input raw file
    tiff = jbtiff.tiff_file(open(args.input, 'rb'))
    # display memory map
    mmap = tiff.get_memorymap()
+   # look up requested offsets, if any
+   if args.query:
+      index = jbtiff.range_map(mmap)
+      for x in args.query:
+         objects = index.find(x)
+         if not objects:
+            print "%8d (0x%08x):\tunused" % (x, x)
+         for offset, length, description in objects:
+            print "%8d (0x%08x):\t%8d - %8d\t%s" % (x, x, offset, offset+length-1, description)
+      return
    print "*** Memory Map ***"
    next_offset = 0
    for offset, length, description in sorted(mmap):
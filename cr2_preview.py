@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
+import jbtiff
+import jbimage
+
+## main program
+
+def main():
+   # interpret user options
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-i", "--input", required=True,
+                     help="input raw file to read")
+   parser.add_argument("-o", "--output", required=True,
+                     help="output preview file (JPEG for IFD#0/1, PPM for IFD#2)")
+   parser.add_argument("-k", "--ifd", type=int, choices=[0, 1, 2], default=0,
+                     help="IFD holding the preview (default: %(default)s)")
+   args = parser.parse_args()
+
+   # read input file directories (data strips are not read)
+   tiff = jbtiff.tiff_file(open(args.input, 'rb'))
+
+   if args.ifd == 2:
+      # small uncompressed RGB image
+      a = tiff.get_rgb_image(args.ifd)
+      if a.dtype.itemsize == 2:
+         a = a.astype('>H')
+      jbimage.pnm_file.write(a, open(args.output, 'wb'))
+   else:
+      # embedded JPEG image, copied as is
+      IFD, ifd_offset, strips = tiff.data[args.ifd]
+      with open(args.output, 'wb') as fid:
+         for strip in strips:
+            jbtiff.tiff_file.write_strip(fid, strip)
+   return
+
+# main entry point
+if __name__ == '__main__':
+   main()
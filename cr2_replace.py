@@ -20,7 +20,6 @@
 
 import sys
 import os
-import tempfile
 import argparse
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
@@ -49,23 +48,14 @@ def main():
    width,height = tiff.get_sensor_size()
    slices = tiff.get_slices()
 
-   # extract existing sensor image
-   IFD, ifd_offset, strips = tiff.data[3]
-   # save into a temporary file
-   fid, tmpfile = tempfile.mkstemp()
-   for strip in strips:
-      os.write(fid, strip)
-   os.close(fid)
-   # decode lossless JPEG encoded file to determine parameters
-   a, components, precision = jbcr2.decode_lossless_jpeg(tmpfile)
-   # delete temporary file
-   os.remove(tmpfile)
-   # store decoded sensor image file as needed
+   # determine parameters of existing sensor image
+   k = tiff.get_raw_ifd()
+   data = tiff.get_data(k)
+   components, precision = jbcr2.get_lossless_jpeg_parameters(data)
+   # decode and store sensor image file as needed
    if args.decode:
-      # unslice image
-      I = jbcr2.unslice_image(a, width, height, slices)
-      # save result
-      jbimage.pnm_file.write(I.astype('>H'), open(args.decode,'wb'))
+      I = jbcr2.decode_sensor_image(data, width, height, slices)
+      jbimage.pnm_file.write(I, open(args.decode,'wb'))
 
    # read sensor image file
    sensor = jbimage.image_file.read(args.sensor).squeeze()
@@ -80,22 +70,14 @@ def main():
    # check input image parameters
    assert len(sensor.shape) == 2 # must be a one-channel image
    assert sensor.shape == (height,width) # image size must be exact
-   # slice image
-   a = jbcr2.slice_image(sensor, width, height, slices)
-   # encode to a temporary lossless JPEG output file
-   fid, tmpfile = tempfile.mkstemp()
-   os.close(fid)
-   parts = jbcr2.encode_lossless_jpeg(a, components, precision, tmpfile)
-   # read and delete temporary file
-   with open(tmpfile, 'rb') as fid:
-      data = fid.read()
-   os.remove(tmpfile)
+   # encode as lossless JPEG
+   data = jbcr2.encode_sensor_image(sensor, width, height, slices, components, precision)
 
-   # replace data strips for main sensor image (IFD#3)
-   jbcr2.replace_ifd(tiff, 3, data)
+   # replace data strips for main sensor image
+   jbcr2.replace_ifd(tiff, k, data)
 
    # save updated CR2 file
-   tiff.write(open(args.output,'wb'))
+   tiff.write_file(args.output)
    return
 
 # main entry point
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import numpy as np
+
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+## class for an on-disk cache of decoded arrays, addressed by content
+## (arrays are stored as .npy files, and memory-mapped when read; entries
+## are replaced by atomic rename, so the cache can be shared by concurrent
+## processes; the least recently used entries are removed beyond a size limit)
+
+class array_cache():
+
+   # default location and size limit, overridden by environment variables
+   default_folder = os.path.join(os.path.expanduser('~'), '.cache', 'cr2_scripts')
+   default_size = 4<<30
+
+   # initialize with cache folder and size limit in bytes
+   def __init__(self, folder=None, max_size=None):
+      if folder is None:
+         folder = os.environ.get('CR2_SCRIPTS_CACHE', array_cache.default_folder)
+      if max_size is None:
+         max_size = int(os.environ.get('CR2_SCRIPTS_CACHE_SIZE', array_cache.default_size))
+      self.folder = folder
+      self.max_size = max_size
+      return
+
+   # make key from data (any object with buffer interface) and parameters
+   @staticmethod
+   def make_key(data, *parameters):
+      h = hashlib.sha1(data)
+      h.update(repr(parameters))
+      return h.hexdigest()
+
+   # get filename for given key
+   def get_filename(self, key):
+      return os.path.join(self.folder, key + '.npy')
+
+   # get array for given key (read-only, memory-mapped), or None if not cached
+   def get(self, key):
+      filename = self.get_filename(key)
+      try:
+         a = np.load(filename, mmap_mode='r')
+      except (IOError, OSError, ValueError):
+         return None
+      # mark as recently used
+      try:
+         os.utime(filename, None)
+      except OSError:
+         pass
+      return a
+
+   # store array for given key, then remove old entries as needed
+   def put(self, key, a):
+      try:
+         if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+      except OSError as e:
+         if e.errno != errno.EEXIST:
+            print "Cannot create cache folder %s: %s" % (self.folder, e)
+            return
+      # write to a temporary file, then move into place
+      try:
+         fid, tmpfile = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+         with os.fdopen(fid, 'wb') as f:
+            np.save(f, a)
+         os.rename(tmpfile, self.get_filename(key))
+      except (IOError, OSError) as e:
+         print "Cannot write to cache folder %s: %s" % (self.folder, e)
+         return
+      self.evict()
+      return
+
+   # remove least recently used entries until within the size limit
+   # (one process at a time)
+   def evict(self):
+      with open(os.path.join(self.folder, '.lock'), 'w') as lock:
+         if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+         entries = []
+         for name in os.listdir(self.folder):
+            try:
+               st = os.stat(os.path.join(self.folder, name))
+               # remove temporary files left behind by interrupted writes
+               if name.endswith('.tmp') and st.st_mtime < time.time() - 3600:
+                  os.remove(os.path.join(self.folder, name))
+            except OSError:
+               continue
+            if name.endswith('.npy'):
+               entries.append((st.st_mtime, st.st_size, name))
+         entries.sort()
+         total = sum([size for mtime, size, name in entries])
+         for mtime, size, name in entries:
+            if total <= self.max_size:
+               break
+            try:
+               os.remove(os.path.join(self.folder, name))
+            except OSError:
+               pass
+            total -= size
+      return
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import struct
+import sqlite3
+import hashlib
+
+import jbtiff
+
+## class for a persistent catalog of CR2 file metadata (using SQLite)
+
+class catalog():
+
+   # file extensions to include when scanning a directory tree
+   extensions = ['.cr2']
+
+   # fields stored for each file, with SQL type (lists are stored as JSON)
+   fields = [
+      ('path', 'TEXT PRIMARY KEY'),
+      ('mtime', 'REAL'),
+      ('size', 'INTEGER'),
+      ('model', 'TEXT'),
+      ('sensor_width', 'INTEGER'),
+      ('sensor_height', 'INTEGER'),
+      ('slices', 'TEXT'),
+      ('border', 'TEXT'),
+      ('layout', 'TEXT'),
+      ]
+   json_fields = ['slices', 'border', 'layout']
+
+   # number of files added or updated between commits when scanning
+   batch_size = 100
+
+   # open catalog file, creating it if necessary
+   def __init__(self, filename):
+      self.db = sqlite3.connect(filename)
+      self.db.execute('CREATE TABLE IF NOT EXISTS files (%s)' % \
+         ', '.join(['%s %s' % field for field in catalog.fields]))
+      self.db.execute('CREATE TABLE IF NOT EXISTS strips ' \
+         '(path TEXT, ifd INTEGER, strip INTEGER, offset INTEGER, length INTEGER, sha1 TEXT, ' \
+         'PRIMARY KEY (path, ifd, strip))')
+      self.db.execute('CREATE INDEX IF NOT EXISTS strips_sha1 ON strips (sha1)')
+      self.db.commit()
+      return
+
+   # close catalog file
+   def close(self):
+      self.db.close()
+      return
+
+   # determine metadata for given file, as a dictionary of fields
+   @staticmethod
+   def read_metadata(path):
+      record = dict.fromkeys([name for name, sql_type in catalog.fields])
+      st = os.stat(path)
+      record['path'] = path
+      record['mtime'] = st.st_mtime
+      record['size'] = st.st_size
+      # parse file (directories only)
+      with open(path, 'rb') as fid:
+         tiff = jbtiff.tiff_file(fid)
+         record['model'] = tiff.get_model(0)
+         sensor = tiff.get_sensor_size()
+         if sensor:
+            record['sensor_width'], record['sensor_height'] = sensor
+         slices = tiff.get_slices()
+         if slices:
+            record['slices'] = list(slices)
+         border = tiff.get_border()
+         if border:
+            record['border'] = list(border)
+         # IFD layout with strip locations and hashes
+         layout = []
+         for k, (IFD, ifd_offset, strips) in enumerate(tiff.data):
+            tag_offset, tag_length = jbtiff.tiff_file.get_strip_parameters(IFD)
+            items = []
+            for i, strip in enumerate(strips):
+               sha1 = hashlib.sha1(jbtiff.tiff_file.get_buffer(strip)).hexdigest()
+               items.append([IFD[tag_offset][2][i], IFD[tag_length][2][i], sha1])
+            layout.append({'offset': ifd_offset, 'entries': len(IFD), 'strips': items})
+         record['layout'] = layout
+      return record
+
+   # add or replace the record for given file
+   def add_file(self, path):
+      path = os.path.realpath(path)
+      record = catalog.read_metadata(path)
+      values = [json.dumps(record[name]) if name in catalog.json_fields else record[name] \
+         for name, sql_type in catalog.fields]
+      self.db.execute('DELETE FROM strips WHERE path = ?', (path,))
+      self.db.execute('INSERT OR REPLACE INTO files VALUES (%s)' % \
+         ', '.join(['?'] * len(catalog.fields)), values)
+      for k, ifd in enumerate(record['layout']):
+         for i, (offset, length, sha1) in enumerate(ifd['strips']):
+            self.db.execute('INSERT INTO strips VALUES (?, ?, ?, ?, ?, ?)', \
+               (path, k, i, offset, length, sha1))
+      return
+
+   # remove the record for given file
+   def remove_file(self, path):
+      self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+      self.db.execute('DELETE FROM strips WHERE path = ?', (path,))
+      return
+
+   # scan directory tree, updating records for new or changed files (by
+   # modification time and size) and removing records for deleted files;
+   # changes are committed in batches, so progress is kept if interrupted;
+   # returns the number of files added/updated, unchanged, and removed, and
+   # a list of (path, reason) for files that could not be catalogued
+   def update(self, root):
+      root = os.path.realpath(root)
+      # get existing records under this tree
+      prefix = os.path.join(root, '')
+      known = {}
+      for path, mtime, size in self.db.execute( \
+            'SELECT path, mtime, size FROM files WHERE substr(path, 1, ?) = ?', \
+            (len(prefix), prefix)):
+         known[path] = (mtime, size)
+      updated = 0
+      unchanged = 0
+      failed = []
+      for dirpath, dirnames, filenames in os.walk(root):
+         for filename in filenames:
+            if os.path.splitext(filename)[1].lower() not in catalog.extensions:
+               continue
+            path = os.path.realpath(os.path.join(dirpath, filename))
+            try:
+               st = os.stat(path)
+               if known.pop(path, None) == (st.st_mtime, st.st_size):
+                  unchanged += 1
+                  continue
+               self.add_file(path)
+               updated += 1
+            except (AssertionError, ValueError, IOError, OSError, KeyError, IndexError, struct.error) as e:
+               # drop any stale record, as the file is no longer readable
+               self.remove_file(path)
+               failed.append((path, str(e)))
+            if (updated + len(failed)) % catalog.batch_size == 0:
+               self.db.commit()
+      # anything left was not found, so remove it
+      for path in known:
+         self.remove_file(path)
+      self.db.commit()
+      return updated, unchanged, len(known), failed
+
+   # convert database row to a dictionary of fields
+   @staticmethod
+   def make_record(row):
+      record = {}
+      for (name, sql_type), value in zip(catalog.fields, row):
+         if name in catalog.json_fields and value is not None:
+            value = json.loads(value)
+         record[name] = value
+      return record
+
+   # get record for given file, or None if not in catalog
+   def lookup(self, path):
+      path = os.path.realpath(path)
+      row = self.db.execute('SELECT * FROM files WHERE path = ?', (path,)).fetchone()
+      if row is None:
+         return None
+      return catalog.make_record(row)
+
+   # get records matching all given field values (e.g. model='Canon EOS 450D')
+   def query(self, **conditions):
+      for name in conditions:
+         assert name in [field for field, sql_type in catalog.fields]
+      sql = 'SELECT * FROM files'
+      if conditions:
+         sql += ' WHERE ' + ' AND '.join(['%s = ?' % name for name in conditions])
+      sql += ' ORDER BY path'
+      return [catalog.make_record(row) for row in self.db.execute(sql, conditions.values())]
+
+   # get (path, ifd, strip) for all strips with given SHA-1 hash
+   def find_strip(self, sha1):
+      return self.db.execute('SELECT path, ifd, strip FROM strips WHERE sha1 = ? ORDER BY path, ifd, strip', \
+         (sha1,)).fetchall()
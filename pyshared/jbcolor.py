@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing.pool
+import numpy as np
+
+import jbtiff
+
+## demosaic methods
+
+methods = ['nearest', 'bilinear', 'malvar']
+
+## interpolation kernels for a missing color at a site, as lists of
+## ((dy,dx), weight), for each method and each kind of site:
+## 'g' - green at a red/blue site
+## 'row' - red/blue at a green site, with that color to the left and right
+## 'col' - red/blue at a green site, with that color above and below
+## 'diag' - red/blue at a blue/red site
+
+kernels = {
+   'bilinear': {
+      'g': [((-1,0),0.25), ((1,0),0.25), ((0,-1),0.25), ((0,1),0.25)],
+      'row': [((0,-1),0.5), ((0,1),0.5)],
+      'col': [((-1,0),0.5), ((1,0),0.5)],
+      'diag': [((-1,-1),0.25), ((-1,1),0.25), ((1,-1),0.25), ((1,1),0.25)],
+      },
+   # gradient-corrected linear interpolation (Malvar, He & Cutler, 2004)
+   'malvar': {
+      'g': [((0,0),4/8.), ((-1,0),2/8.), ((1,0),2/8.), ((0,-1),2/8.), ((0,1),2/8.),
+         ((-2,0),-1/8.), ((2,0),-1/8.), ((0,-2),-1/8.), ((0,2),-1/8.)],
+      'row': [((0,0),5/8.), ((0,-1),4/8.), ((0,1),4/8.),
+         ((-1,-1),-1/8.), ((-1,1),-1/8.), ((1,-1),-1/8.), ((1,1),-1/8.),
+         ((0,-2),-1/8.), ((0,2),-1/8.), ((-2,0),0.5/8.), ((2,0),0.5/8.)],
+      'col': [((0,0),5/8.), ((-1,0),4/8.), ((1,0),4/8.),
+         ((-1,-1),-1/8.), ((-1,1),-1/8.), ((1,-1),-1/8.), ((1,1),-1/8.),
+         ((-2,0),-1/8.), ((2,0),-1/8.), ((0,-2),0.5/8.), ((0,2),0.5/8.)],
+      'diag': [((0,0),6/8.), ((-1,-1),2/8.), ((-1,1),2/8.), ((1,-1),2/8.), ((1,1),2/8.),
+         ((-2,0),-1.5/8.), ((2,0),-1.5/8.), ((0,-2),-1.5/8.), ((0,2),-1.5/8.)],
+      },
+   }
+
+# number of rows/columns beyond a tile needed by each method
+halo = {'nearest': 1, 'bilinear': 1, 'malvar': 2}
+
+## get color channel (0=R, 1=G, 2=B) at each position of the 2x2 Bayer pattern
+## (first letter pair for odd rows, second pair for even rows)
+
+def get_bayer_map(bayer):
+   assert len(bayer) == 4
+   cmap = {v: k for k, v in enumerate("RGB")}
+   return [[cmap[bayer[0]], cmap[bayer[1]]], [cmap[bayer[2]], cmap[bayer[3]]]]
+
+## get kind of interpolation needed for color channel 'ch' at Bayer position
+## (i,j), or None if this color is sampled there
+
+def get_site_kind(m, i, j, ch):
+   if m[i][j] == ch:
+      return None
+   if ch == 1:
+      if m[1-i][j] == 1 and m[i][1-j] == 1:
+         return 'g'
+   elif m[i][j] == 1:
+      if m[i][1-j] == ch:
+         return 'row'
+      if m[1-i][j] == ch:
+         return 'col'
+   elif m[1-i][1-j] == ch:
+      return 'diag'
+   raise ValueError("Bayer pattern not supported for interpolation")
+
+## nearest-neighbour demosaic: copy each missing color from the same 2x2 cell
+## (for green, from the same row of the cell where possible)
+
+def demosaic_nearest(M, bayer, out):
+   assert len(bayer) == 4
+   for ch, color in enumerate("RGB"):
+      nn = np.zeros((2,2), dtype=int)
+      nn[:] = -1 # initialize
+      if bayer.count(color) == 1: # there is only one instance
+         nn[:] = bayer.find(color)
+      elif bayer.count(color) == 2: # there are two instances
+         nn[0,:] = bayer.find(color,0,2)
+         nn[1,:] = bayer.find(color,2,4)
+      assert nn.min() >= 0
+      for i in [0,1]:
+         for j in [0,1]:
+            k = nn[i,j]
+            out[i::2,j::2,ch] = M[k//2::2,k%2::2]
+   return out
+
+## interpolating demosaic: apply the method's kernel for each missing color on
+## each of the four Bayer planes, using shifted views of the padded mosaic
+
+def demosaic_filter(M, bayer, method, out):
+   m = get_bayer_map(bayer)
+   height, width = M.shape
+   pad = halo[method]
+   # reflecting about the edge keeps the Bayer pattern of the padded mosaic
+   P = np.pad(M, pad, mode='reflect')
+   for i in [0,1]:
+      for j in [0,1]:
+         h = (height - i + 1) // 2
+         w = (width - j + 1) // 2
+         for ch in range(3):
+            dst = out[i::2,j::2,ch]
+            kind = get_site_kind(m, i, j, ch)
+            if kind is None:
+               dst[...] = M[i::2,j::2]
+               continue
+            dst[...] = 0
+            for (dy,dx), weight in kernels[method][kind]:
+               y = pad + i + dy
+               x = pad + j + dx
+               dst += weight * P[y:y+2*h-1:2,x:x+2*w-1:2]
+   return out
+
+## demosaic sensor image M (mosaic of color samples in given Bayer pattern,
+## as float) with given method, into a new rows x columns x 3 array of the
+## same type or into 'out'
+
+def demosaic(M, bayer, method='nearest', out=None):
+   if out is None:
+      out = np.empty(M.shape + (3,), dtype=M.dtype)
+   if method == 'nearest':
+      return demosaic_nearest(M, bayer, out)
+   elif method in kernels:
+      return demosaic_filter(M, bayer, method, out)
+   raise ValueError("Unknown demosaic method: %s" % method)
+
+## split region of given size into tiles (y, x, h, w) of at most the given size
+
+def get_tiles(height, width, tile_size):
+   return [(y, x, min(tile_size, height - y), min(tile_size, width - x)) \
+      for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+## apply function to each tile of region of given size, on a pool of threads
+## (numpy releases the GIL for the bulk of the work)
+
+def process_tiles(func, height, width, tile_size=256, threads=None):
+   tiles = get_tiles(height, width, tile_size)
+   if threads == 1:
+      map(func, tiles)
+      return
+   pool = multiprocessing.pool.ThreadPool(threads)
+   try:
+      pool.map(func, tiles)
+   finally:
+      pool.close()
+      pool.join()
+   return
+
+## subtract black level and scale each Bayer position of sensor image S
+## (starting at an even row and column) to [0.0,1.0], in given float type
+
+def scale_mosaic(S, black, saturation, dtype=np.float32):
+   M = np.empty(S.shape, dtype=dtype)
+   for k in range(4):
+      i, j = k // 2, k % 2
+      m = M[i::2,j::2]
+      np.subtract(S[i::2,j::2], black[k], out=m, casting='unsafe')
+      m *= 1.0 / (saturation - black[k])
+   return M
+
+## apply affine color transform clip(I . A^T + b, low, high) to array I of
+## color triplets (along the last axis), in a single pass in given float type
+## (A may have fewer rows, to compute only some of the output channels)
+
+def color_transform(I, A, b=0.0, low=0.0, high=1.0, dtype=np.float32):
+   shape = I.shape
+   I = np.ascontiguousarray(I, dtype=dtype).reshape(-1, 3)
+   R = np.dot(I, np.asarray(A, dtype=dtype).transpose())
+   if np.any(b):
+      R += b
+   np.clip(R, low, high, R)
+   R.shape = shape[:-1] + (R.shape[1],)
+   return R
+
+## convert region (x, y, w, h) of sensor image I to 16-bit sRGB, writing into
+## 'out' (h x w x 3); each tile is taken with enough rows and columns around
+## it for the demosaic method, so the result is the same as for the whole
+## image at once
+## (black level and saturation scaling is done on the mosaic, as it may be
+## different for sites of the same color)
+
+def sensor_to_srgb(I, black, saturation, bayer, method, rgb_cam, out, region=None, tile_size=256, threads=None, dtype=np.float32):
+   height, width = I.shape
+   if region is None:
+      region = (0, 0, width, height)
+   rx, ry, rw, rh = region
+   assert rx >= 0 and ry >= 0 and rx + rw <= width and ry + rh <= height
+   assert out.shape == (rh, rw, 3)
+   pad = halo[method]
+   def convert(tile):
+      y, x, h, w = tile
+      # tile with halo, made of whole 2x2 Bayer cells
+      ay = ry + y
+      ax = rx + x
+      ys = max(ay - pad, 0) & ~1
+      xs = max(ax - pad, 0) & ~1
+      ye = min((ay + h + pad + 1) & ~1, height)
+      xe = min((ax + w + pad + 1) & ~1, width)
+      M = scale_mosaic(I[ys:ye,xs:xe], black, saturation, dtype)
+      C = demosaic(M, bayer, method)[ay-ys:ay-ys+h,ax-xs:ax-xs+w]
+      # convert from camera color space to linear RGB D65 space, and limit values
+      C = color_transform(C, rgb_cam, dtype=dtype)
+      # apply sRGB gamma correction and quantize to 16-bit
+      out[y:y+h,x:x+w] = jbtiff.tiff_file.srgb_gamma_quantize(C)
+   process_tiles(convert, rh, rw, tile_size, threads)
+   return out
@@ -19,10 +19,15 @@
 # along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
 import tempfile
-import commands
+import subprocess
+import collections
 import numpy as np
 
+import jbljpeg
+import jbcache
+
 ## replace data strips for specified IFD
 
 def replace_ifd(tiff, k, data):
@@ -46,128 +51,300 @@ def replace_ifd(tiff, k, data):
       raise AssertionError("Reference to data strip not found in IFD#%d" % k)
    return
 
-## convert lossless JPEG encoded input file to raw data
+## create folder for files exchanged with an external codec, in memory if possible
+
+def make_temp_folder():
+   shm = '/dev/shm'
+   if os.path.isdir(shm) and os.access(shm, os.W_OK):
+      return tempfile.mkdtemp(dir=shm)
+   return tempfile.mkdtemp()
+
+## run external command given as argument list, returning status and output
 
-def decode_lossless_jpeg(filename):
+def run_command(args):
+   try:
+      p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+   except OSError as e:
+      return -1, 'Cannot run %s: %s' % (args[0], e)
+   out = p.communicate()[0]
+   return p.returncode, out.rstrip('\n')
+
+## convert lossless JPEG encoded input file to planar color components
+## (components x rows x columns) using PVRG JPEG
+
+def decode_components_pvrg(filename):
    # create folder for temporary files
-   tmpfolder = tempfile.mkdtemp()
-
-   # decode input file with Stanford PVRG software
-   cmd = 'pvrg-jpeg -d -s "%s" -o "%s"' % (filename, os.path.join(tmpfolder, "parts"))
-   st, out = commands.getstatusoutput(cmd)
-   if st != 0:
-      raise AssertionError('Error decoding JPEG file: %s' % out)
-
-   # Laurent Clévy's example:
-   # Image (w x h): 5184 x 3456
-   # 4 color components (w x h): 0x538 x 0xdbc = 1336 x 3516 each
-   #    interleaved components: 5344 x 3516
-   #    border: 160 x 60 on declared image size
-   # 3 slices (w): 2x 0x6c0 + 0x760 = 2x 1728 + 1888 = 5344
-   #    each slice takes: 432 pixels from each of 4 colors (first two)
-   #                      472 pixels from each of 4 colors (last one)
-
-   # interpret output to determine the number of color components and precision
-   component_list = []
-   precision = None
-   for line in out.split('\n'):
-      if line.startswith('>> '):
-         record = line.split()
-         f = record[4]
-         w = int(record[6])
-         h = int(record[8])
-         component_list.append((f,w,h))
-      elif line.startswith('Caution: precision type:'):
-         record = line.split()
-         precision = int(record[3])
-         print "RAW data precision: %d" % precision
-   # number of color components
-   n = len(component_list)
-   # first assemble color components
-   width = sum([w for f,w,h in component_list])
-   height = component_list[0][2]
-   assert all([h == height for f,w,h in component_list])
-   a = np.zeros((height, width), dtype=np.dtype('>H'))
-   for i, (f,w,h) in enumerate(component_list):
-      # read raw data for this component
-      b = np.fromfile(f, dtype=np.dtype('>H'))
-      b.shape = (h,w)
-      # insert into assembled color image
-      a[:,i::n] = b
-      # remove temporary file
-      os.remove(f)
-
-   # remove (empty) temporary folder
-   os.rmdir(tmpfolder)
-
-   return a, len(component_list), precision
-
-## encode raw image to lossless JPEG output file
-
-def encode_lossless_jpeg(a, components, precision, filename):
+   tmpfolder = make_temp_folder()
+   try:
+      # decode input file with Stanford PVRG software
+      st, out = run_command(['pvrg-jpeg', '-d', '-s', filename, '-o', os.path.join(tmpfolder, "parts")])
+      if st != 0:
+         raise AssertionError('Error decoding JPEG file: %s' % out)
+
+      # Laurent Clévy's example:
+      # Image (w x h): 5184 x 3456
+      # 4 color components (w x h): 0x538 x 0xdbc = 1336 x 3516 each
+      #    interleaved components: 5344 x 3516
+      #    border: 160 x 60 on declared image size
+      # 3 slices (w): 2x 0x6c0 + 0x760 = 2x 1728 + 1888 = 5344
+      #    each slice takes: 432 pixels from each of 4 colors (first two)
+      #                      472 pixels from each of 4 colors (last one)
+
+      # interpret output to determine the number of color components and precision
+      component_list = []
+      precision = None
+      for line in out.split('\n'):
+         if line.startswith('>> '):
+            record = line.split()
+            f = record[4]
+            w = int(record[6])
+            h = int(record[8])
+            component_list.append((f,w,h))
+         elif line.startswith('Caution: precision type:'):
+            record = line.split()
+            precision = int(record[3])
+            print "RAW data precision: %d" % precision
+      # number of color components
+      n = len(component_list)
+      height = component_list[0][2]
+      assert all([h == height for f,w,h in component_list])
+      assert all([w == component_list[0][1] for f,w,h in component_list])
+      # read raw data for each component straight into its plane
+      planes = np.empty((n, height, component_list[0][1]), dtype=np.dtype('>H'))
+      for i, (f,w,h) in enumerate(component_list):
+         with open(f, 'rb') as fid:
+            if fid.readinto(planes[i]) != planes[i].nbytes:
+               raise AssertionError('Short component file: %s' % f)
+   finally:
+      # remove temporary folder and anything left in it
+      shutil.rmtree(tmpfolder, ignore_errors=True)
+
+   return planes, precision
+
+## split raw image into its color components
+
+def split_components(a, components):
+   return [a[:,i::components] for i in range(components)]
+
+## encode color components (list of arrays) to lossless JPEG output file
+## using PVRG JPEG
+
+def encode_components_pvrg(parts, precision, filename):
    # create folder for temporary files
-   tmpfolder = tempfile.mkdtemp()
-
-   # determine image size
-   height, width = a.shape
-   # determine color components to create
-   component_list = []
-   for i in range(components):
-      f = os.path.join(tmpfolder, 'parts.%d' % (i+1))
-      component_list.append(f)
-   # next split color components
-   parts = []
-   for i, f in enumerate(component_list):
-      # space for raw data for this color component
-      b = np.zeros((height, width / components), dtype=np.dtype('>H'))
-      # extract data from sliced color image
-      b = a[:,i::components]
-      # save to file
-      b.tofile(f)
-      # keep a copy to return to caller
-      parts.append(b)
-
-   # convert raw data color components to lossless JPEG encoded file
-   cmd = 'pvrg-jpeg -ih %d -iw %d -k 1 -p %d -s "%s"' % \
-      (height, width / components, precision, filename)
-   for i, f in enumerate(component_list):
-      cmd += ' -ci %d %s' % (i+1, f)
-   st, out = commands.getstatusoutput(cmd)
-   if st != 0:
-      raise AssertionError('Error encoding JPEG file: %s' % out)
-
-   # remove temporary files
-   for i, f in enumerate(component_list):
-      os.remove(f)
-
-   # remove (empty) temporary folder
-   os.rmdir(tmpfolder)
-   return parts
-
-## unslice sensor image
-
-def unslice_image(a, width, height, slices):
-   # make a list of the width of each slice
-   slice_widths = [slices[1]] * slices[0] + [slices[2]]
-   assert sum(slice_widths) == width
-   # unslice image
-   I = np.zeros((height, width), dtype=np.dtype('>H'))
-   for i, sw in enumerate(slice_widths):
-      col_s = sum(slice_widths[0:i])
-      col_e = col_s + sw
-      I[:,col_s:col_e] = a.flat[col_s*height:col_e*height].reshape(height,sw)
-   return I
+   tmpfolder = make_temp_folder()
+   try:
+      # determine image size
+      height, width = parts[0].shape
+      # save each color component to a file
+      args = ['pvrg-jpeg', '-ih', str(height), '-iw', str(width),
+         '-k', '1', '-p', str(precision), '-s', filename]
+      for i, b in enumerate(parts):
+         f = os.path.join(tmpfolder, 'parts.%d' % (i+1))
+         b.astype('>H').tofile(f)
+         args += ['-ci', str(i+1), f]
+
+      # convert raw data color components to lossless JPEG encoded file
+      st, out = run_command(args)
+      if st != 0:
+         raise AssertionError('Error encoding JPEG file: %s' % out)
+   finally:
+      # remove temporary folder and anything left in it
+      shutil.rmtree(tmpfolder, ignore_errors=True)
+   return
+
+## The sensor image is a permutation of the sequence of samples in the
+## lossless JPEG scan (color components interleaved, row by row): this
+## sequence is cut into consecutive runs, one for each slice, each made of
+## the slice's rows in order. The functions below move samples between the
+## two layouts in a single pass, using strided views of each run.
+
+## get the number and width of slices, and width of last slice (or of the
+## whole image if not sliced)
+
+def get_slice_layout(width, slices):
+   if slices is None:
+      return 0, 0, width
+   n, sw, lw = slices
+   assert n * sw + lw == width
+   return n, sw, lw
+
+## unslice sensor image from sequence of samples in scan order (array of any
+## shape), into a new sensor image with given type or into 'out'
+
+def unslice_image(a, width, height, slices, dtype='>H', out=None):
+   n, sw, lw = get_slice_layout(width, slices)
+   k = n * sw
+   s = a.reshape(-1)
+   assert len(s) == width * height
+   if out is None:
+      out = np.empty((height, width), dtype=dtype)
+   # equal-width slices, as a view of the output (setting shape never copies)
+   view = out[:,:k].view()
+   view.shape = (height, n, sw)
+   view[...] = s[:k*height].reshape(n, height, sw).transpose(1,0,2)
+   # last slice
+   out[:,k:] = s[k*height:].reshape(height, lw)
+   return out
+
+## slice sensor image into sequence of samples in scan order, as an array
+## of rows x width with given type
 
-## slice sensor image
-
-def slice_image(I, width, height, slices):
-   # make a list of the width of each slice
-   slice_widths = [slices[1]] * slices[0] + [slices[2]]
-   assert sum(slice_widths) == width
-   # slice image
-   a = np.zeros((height, width), dtype=np.dtype('>H'))
-   for i, sw in enumerate(slice_widths):
-      col_s = sum(slice_widths[0:i])
-      col_e = col_s + sw
-      a.flat[col_s*height:col_e*height] = I[:,col_s:col_e].flat
+def slice_image(I, width, height, slices, dtype='>H'):
+   n, sw, lw = get_slice_layout(width, slices)
+   k = n * sw
+   assert I.shape == (height, width)
+   a = np.empty((height, width), dtype=dtype)
+   s = a.reshape(-1)
+   # equal-width slices
+   view = I[:,:k].view()
+   view.shape = (height, n, sw)
+   s[:k*height].reshape(n, height, sw)[...] = view.transpose(1,0,2)
+   # last slice
+   s[k*height:].reshape(height, lw)[...] = I[:,k:]
    return a
+
+## get column range (start, end) of each slice
+
+def get_slice_ranges(width, slices):
+   n, sw, lw = get_slice_layout(width, slices)
+   return [(i * sw, (i+1) * sw) for i in range(n)] + [(n * sw, width)]
+
+## get number of rows of samples in scan order needed for given region of
+## sensor image (x, y, w, h)
+
+def get_region_rows(width, height, slices, roi):
+   x, y, w, h = roi
+   last = 0
+   for cs, ce in get_slice_ranges(width, slices):
+      if ce > x and cs < x + w:
+         # last sample needed in this slice (end of last row of region)
+         last = max(last, cs * height + (y + h) * (ce - cs) - 1)
+   return last // width + 1
+
+## extract region of sensor image (x, y, w, h) from the start of the
+## sequence of samples in scan order (array of any shape, with at least the
+## rows needed), into a new array with given type
+
+def unslice_region(a, width, height, slices, roi, dtype='>H'):
+   x, y, w, h = roi
+   assert 0 <= x and 0 < w and x + w <= width
+   assert 0 <= y and 0 < h and y + h <= height
+   s = a.reshape(-1)
+   out = np.empty((h, w), dtype=dtype)
+   for cs, ce in get_slice_ranges(width, slices):
+      lo = max(x, cs)
+      hi = min(x + w, ce)
+      if lo < hi:
+         # rows of this slice up to the end of the region
+         run = s[cs * height : cs * height + (y + h) * (ce - cs)].reshape(y + h, ce - cs)
+         out[:,lo-x:hi-x] = run[y:,lo-cs:hi-cs]
+   return out
+
+## cache of index arrays for recently used geometries (least recent first)
+
+index_cache = collections.OrderedDict()
+index_cache_size = 4
+
+## get position in planar color components (components x rows x columns)
+## of each sensor image pixel (as a read-only array, shared between calls)
+
+def get_component_index(width, height, slices, components):
+   key = (width, height, None if slices is None else tuple(slices), components)
+   index = index_cache.pop(key, None)
+   if index is None:
+      i = unslice_image(np.arange(width * height, dtype=np.int32), width, height, slices, dtype=np.int32)
+      index = (i % components) * (width * height // components) + i // components
+      index.flags.writeable = False
+      while len(index_cache) >= index_cache_size:
+         index_cache.popitem(last=False)
+   index_cache[key] = index
+   return index
+
+## get lossless JPEG parameters (number of color components and precision)
+## without decoding
+
+def get_lossless_jpeg_parameters(data):
+   d = jbljpeg.decoder(data)
+   return d.components, d.precision
+
+## decode lossless JPEG encoded data directly to sensor image, or to the
+## given region of it (x, y, w, h); whole images are kept in the given cache
+## (True for the default cache) and regions are taken from there if possible
+
+def decode_sensor_image(data, width, height, slices, backend='native', roi=None, processes=None, cache=True):
+   if cache is True:
+      cache = jbcache.array_cache()
+   if cache:
+      key = jbcache.array_cache.make_key(data, width, height, None if slices is None else tuple(slices))
+      I = cache.get(key)
+      if I is not None:
+         print "Using cached sensor image %s" % key
+         if roi is not None:
+            x, y, w, h = roi
+            return np.array(I[y:y+h,x:x+w])
+         return I
+   I = decode_sensor_image_uncached(data, width, height, slices, backend, roi, processes)
+   if cache and roi is None:
+      cache.put(key, I)
+   return I
+
+## decode lossless JPEG encoded data directly to sensor image, or to the
+## given region of it (x, y, w, h), decoding only as far as needed; the
+## native decoder can use several processes for a whole image
+
+def decode_sensor_image_uncached(data, width, height, slices, backend='native', roi=None, processes=None):
+   if backend == 'native':
+      d = jbljpeg.decoder(data)
+      print "RAW data precision: %d" % d.precision
+      if roi is None:
+         return unslice_image(d.decode(processes=processes), width, height, slices)
+      rows = get_region_rows(width, height, slices, roi)
+      print "Decoding %d of %d rows" % (rows, d.height)
+      return unslice_region(d.decode(rows), width, height, slices, roi)
+   elif backend == 'pvrg':
+      tmpfolder = make_temp_folder()
+      try:
+         filename = os.path.join(tmpfolder, 'input.ljpg')
+         with open(filename, 'wb') as fid:
+            fid.write(data)
+         planes, precision = decode_components_pvrg(filename)
+      finally:
+         shutil.rmtree(tmpfolder, ignore_errors=True)
+      index = get_component_index(width, height, slices, len(planes))
+      if roi is not None:
+         x, y, w, h = roi
+         index = index[y:y+h,x:x+w]
+      return planes.reshape(-1).take(index)
+   raise ValueError('Unknown lossless JPEG backend: %s' % backend)
+
+## decode sensor image (or a region of it) directly from the RAW IFD data
+## strip of a parsed CR2 file
+
+def decode_raw_ifd(tiff, backend='native', roi=None, processes=None, cache=True):
+   width,height = tiff.get_sensor_size()
+   slices = tiff.get_slices()
+   k = tiff.get_raw_ifd()
+   if k is None:
+      raise ValueError('No RAW IFD found')
+   return decode_sensor_image(tiff.get_data(k), width, height, slices, backend, roi, processes, cache)
+
+## encode sensor image directly to lossless JPEG data
+
+def encode_sensor_image(I, width, height, slices, components, precision, backend='native'):
+   if backend == 'native':
+      a = slice_image(I, width, height, slices, dtype=np.int32)
+      return jbljpeg.encode(a, components, precision)
+   elif backend == 'pvrg':
+      index = get_component_index(width, height, slices, components)
+      planes = np.empty((components, height, width // components), dtype=np.dtype('>H'))
+      planes.reshape(-1)[index] = I
+      tmpfolder = make_temp_folder()
+      try:
+         filename = os.path.join(tmpfolder, 'output.ljpg')
+         encode_components_pvrg(planes, precision, filename)
+         with open(filename, 'rb') as fid:
+            data = fid.read()
+      finally:
+         shutil.rmtree(tmpfolder, ignore_errors=True)
+      return data
+   raise ValueError('Unknown lossless JPEG backend: %s' % backend)
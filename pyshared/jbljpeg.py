@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015-2018 Johann A. Briffa
+#
+# This file is part of CR2_Scripts.
+#
+# CR2_Scripts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CR2_Scripts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
+
+# Lossless JPEG (ITU-T T.81 process 14, Huffman-coded, SOF3) codec.
+#
+# Decoding is split into three stages:
+# 1) A table lookup gives the total length (Huffman code and additional
+#    bits) of a coded difference starting at any bit position; this is
+#    computed for all bit positions at once.
+# 2) The start of each coded difference is found by following the chain of
+#    lengths from the start of the scan; this is the only sequential part.
+# 3) The differences are extracted at all start positions, and the samples
+#    reconstructed from the predictor, again for all positions at once.
+
+import struct
+import multiprocessing
+import numpy as np
+
+## JPEG markers
+
+SOI = 0xd8
+EOI = 0xd9
+SOF3 = 0xc3
+DHT = 0xc4
+SOS = 0xda
+DRI = 0xdd
+
+## class for a Huffman table, with lookup tables indexed by the next 16 bits
+
+class huffman_table():
+
+   # initialize from list of code counts for each length (1-16) and symbols
+   def __init__(self, bits, values):
+      assert len(bits) == 16
+      assert sum(bits) == len(values)
+      self.bits = list(bits)
+      self.values = list(values)
+      # code length and symbol for each 16-bit prefix (length zero if invalid)
+      self.lut_length = np.zeros(1<<16, dtype=np.uint8)
+      self.lut_symbol = np.zeros(1<<16, dtype=np.uint8)
+      # code and code length for each symbol (for encoding)
+      self.code = np.zeros(256, dtype=np.int64)
+      self.size = np.zeros(256, dtype=np.int64)
+      # assign canonical codes in order of increasing length
+      code = 0
+      k = 0
+      for length in range(1,17):
+         for i in range(bits[length-1]):
+            lo = code << (16 - length)
+            hi = (code + 1) << (16 - length)
+            self.lut_length[lo:hi] = length
+            self.lut_symbol[lo:hi] = values[k]
+            self.code[values[k]] = code
+            self.size[values[k]] = length
+            code += 1
+            k += 1
+         code <<= 1
+      # total length of coded difference (invalid codes given a length of
+      # one, so that a chain walk always makes progress)
+      extra = np.where(self.lut_symbol == 16, 0, self.lut_symbol)
+      self.lut_total = (self.lut_length + extra).astype(np.uint8)
+      self.lut_total[self.lut_length == 0] = 1
+      return
+
+   # create optimal table for given symbol frequencies, with code lengths
+   # limited to 16 bits (ITU-T T.81 Annex K.2)
+   @staticmethod
+   def from_frequencies(freq):
+      # add a reserved symbol, so that no code consists of all ones
+      freq = list(freq) + [1]
+      n = len(freq)
+      codesize = [0] * n
+      others = [-1] * n
+      while True:
+         # find the two least frequent symbols (taking the larger on ties)
+         used = [(f, v) for v, f in enumerate(freq) if f > 0]
+         if len(used) < 2:
+            break
+         used.sort(key=lambda (f, v): (f, -v))
+         v1 = used[0][1]
+         v2 = used[1][1]
+         # merge them into one tree
+         freq[v1] += freq[v2]
+         freq[v2] = 0
+         codesize[v1] += 1
+         while others[v1] >= 0:
+            v1 = others[v1]
+            codesize[v1] += 1
+         others[v1] = v2
+         codesize[v2] += 1
+         while others[v2] >= 0:
+            v2 = others[v2]
+            codesize[v2] += 1
+      # count codes of each length
+      bits = [0] * (max(codesize) + 1)
+      for size in codesize:
+         if size:
+            bits[size] += 1
+      bits += [0] * (17 - len(bits))
+      # limit code lengths to 16 bits
+      for i in range(len(bits)-1, 16, -1):
+         while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+               j -= 1
+            bits[i] -= 2
+            bits[i-1] += 1
+            bits[j+1] += 2
+            bits[j] -= 1
+      # remove the reserved symbol (the last of the longest codes)
+      i = 16
+      while bits[i] == 0:
+         i -= 1
+      bits[i] -= 1
+      # list symbols in order of code length
+      values = sorted([v for v in range(n-1) if codesize[v]], key=lambda v: (codesize[v], v))
+      return huffman_table(bits[1:17], values)
+
+   # get DHT segment content for this table, with given class and identifier
+   def get_segment(self, tc_th):
+      return struct.pack('17B', tc_th, *self.bits) + struct.pack('%dB' % len(self.values), *self.values)
+
+## class for a lossless JPEG decoder
+
+class decoder():
+
+   # size of each block of the entropy-coded segment processed at once (bits)
+   chunk_bits = 1<<19
+
+   # initialize by reading headers from data (any object with buffer interface)
+   def __init__(self, data):
+      buf = np.frombuffer(data, dtype=np.uint8)
+      if len(buf) < 4 or buf[0] != 0xff or buf[1] != SOI:
+         raise ValueError('Not a JPEG stream')
+      tables = {}
+      frame = None
+      pos = 2
+      while True:
+         # find next marker
+         if pos + 4 > len(buf) or buf[pos] != 0xff:
+            raise ValueError('Expected marker at %d' % pos)
+         marker = buf[pos+1]
+         if marker == 0xff: # fill byte
+            pos += 1
+            continue
+         if marker == EOI:
+            raise ValueError('No scan found')
+         length = (int(buf[pos+2]) << 8) | int(buf[pos+3])
+         if pos + 2 + length > len(buf):
+            raise ValueError('Truncated marker segment at %d' % pos)
+         segment = buf[pos+4:pos+2+length].tostring()
+         pos += 2 + length
+         if marker == DHT:
+            # read one or more Huffman tables
+            i = 0
+            while i < len(segment):
+               tc_th = ord(segment[i])
+               bits = struct.unpack('16B', segment[i+1:i+17])
+               values = struct.unpack('%dB' % sum(bits), segment[i+17:i+17+sum(bits)])
+               tables[tc_th & 0x0f] = huffman_table(bits, values)
+               i += 17 + sum(bits)
+         elif marker == SOF3:
+            precision, height, width, nf = struct.unpack('>BHHB', segment[0:6])
+            frame = []
+            for i in range(nf):
+               c, hv, tq = struct.unpack('BBB', segment[6+3*i:9+3*i])
+               if hv != 0x11:
+                  raise ValueError('Subsampled components are not supported')
+               frame.append(c)
+            self.precision = precision
+            self.height = height
+            self.width = width
+         elif marker in [0xc0, 0xc1, 0xc2, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]:
+            raise ValueError('Not a Huffman-coded lossless JPEG stream (SOF%d)' % (marker - 0xc0))
+         elif marker == DRI:
+            if struct.unpack('>H', segment[0:2])[0] != 0:
+               raise ValueError('Restart intervals are not supported')
+         elif marker == SOS:
+            if frame is None:
+               raise ValueError('Scan found before frame header')
+            ns = ord(segment[0])
+            if ns != len(frame):
+               raise ValueError('Non-interleaved scans are not supported')
+            self.tables = []
+            for i in range(ns):
+               cs, td_ta = struct.unpack('BB', segment[1+2*i:3+2*i])
+               assert cs == frame[i]
+               self.tables.append(tables[td_ta >> 4])
+            self.predictor, se, ah_al = struct.unpack('BBB', segment[1+2*ns:4+2*ns])
+            self.point_transform = ah_al & 0x0f
+            if not 1 <= self.predictor <= 7:
+               raise ValueError('Unsupported predictor %d' % self.predictor)
+            break
+      self.components = len(frame)
+      # find end of entropy-coded segment (first marker that is not stuffing)
+      ecs = buf[pos:]
+      ff = np.flatnonzero(ecs[:-1] == 0xff)
+      markers = ff[ecs[ff+1] != 0x00]
+      if len(markers):
+         ecs = ecs[:markers[0]]
+         ff = ff[ff < markers[0]]
+      # remove stuffed zero bytes, and pad with zeros for lookahead
+      keep = np.ones(len(ecs), dtype=bool)
+      keep[ff[ff+1 < len(ecs)] + 1] = False
+      self.nbits = int(keep.sum()) * 8
+      self.ecs = np.zeros(self.nbits // 8 + self.chunk_bits // 8 + 64, dtype=np.uint8)
+      self.ecs[:self.nbits // 8] = ecs[keep]
+      return
+
+   # get total length of coded difference at each bit position in given range
+   # of bytes, for given Huffman table
+   def get_lengths(self, table, b0, b1):
+      B = self.ecs
+      w = (B[b0:b1].astype(np.uint32) << 16) | \
+          (B[b0+1:b1+1].astype(np.uint32) << 8) | B[b0+2:b1+2]
+      peek = (w[:,np.newaxis] >> np.arange(8, 0, -1, dtype=np.uint32)) & 0xffff
+      return table.lut_total[peek.ravel()]
+
+   # get coded differences at given bit positions, for given Huffman table
+   def get_differences(self, table, positions):
+      # gather the five bytes from each position, widening only those
+      B = self.ecs
+      b = positions >> 3
+      s = positions & 7
+      w = (B[b].astype(np.int64) << 32) | (B[b+1].astype(np.int64) << 24) | \
+          (B[b+2].astype(np.int64) << 16) | (B[b+3].astype(np.int64) << 8) | B[b+4]
+      peek = (w >> (24 - s)) & 0xffff
+      length = table.lut_length[peek].astype(np.int64)
+      if not length.all():
+         raise ValueError('Invalid Huffman code at bit %d' % positions[np.argmin(length)])
+      ssss = table.lut_symbol[peek].astype(np.int64)
+      # additional bits (none for ssss == 16)
+      n = np.where(ssss == 16, 0, ssss)
+      extra = (w >> (40 - s - length - n)) & ((1 << n) - 1)
+      # extend sign
+      diff = np.where(extra < (1 << np.maximum(n-1, 0)), extra - (1 << n) + 1, extra)
+      diff[ssss == 0] = 0
+      diff[ssss == 16] = 32768
+      return diff
+
+   # find the start of coded differences, following the chain from given bit
+   # position with given first component, until 'count' are found (if given)
+   # or the chain passes bit position 'end' (if given) or the end of data;
+   # returns the array of positions
+   def find_tokens(self, count=None, start=0, first=0, end=None):
+      # Huffman table for each component, in the order used from start
+      nc = self.components
+      order = [self.tables[(first + i) % nc] for i in range(nc)]
+      if end is None or end > self.nbits:
+         end = self.nbits
+      positions = []
+      found = 0
+      # margin beyond each block for coded differences that straddle it
+      margin = nc * 32
+      while (count is None or found < count) and start < end:
+         # set up block starting at the byte holding the next position
+         b0 = start >> 3
+         b1 = b0 + (self.chunk_bits + margin) // 8
+         lengths = [bytearray(self.get_lengths(table, b0, b1).tostring()) for table in order]
+         marks = bytearray(len(lengths[0]))
+         q = start - b0 * 8
+         # follow the chain of lengths through this block, a unit at a time
+         limit = min(self.chunk_bits, end - b0 * 8)
+         if nc == 1:
+            L0, = lengths
+            while q < limit:
+               marks[q] = 1
+               q += L0[q]
+         elif nc == 2:
+            L0, L1 = lengths
+            while q < limit:
+               marks[q] = 1
+               q += L0[q]
+               marks[q] = 1
+               q += L1[q]
+         elif nc == 4:
+            L0, L1, L2, L3 = lengths
+            while q < limit:
+               marks[q] = 1
+               q += L0[q]
+               marks[q] = 1
+               q += L1[q]
+               marks[q] = 1
+               q += L2[q]
+               marks[q] = 1
+               q += L3[q]
+         else:
+            while q < limit:
+               for L in lengths:
+                  marks[q] = 1
+                  q += L[q]
+         # collect positions found, in order
+         p = np.flatnonzero(np.frombuffer(marks, dtype=np.uint8)) + b0 * 8
+         positions.append(p)
+         found += len(p)
+         start = b0 * 8 + q
+      if not positions:
+         return np.zeros(0, dtype=np.int64)
+      return np.concatenate(positions)[:count]
+
+   # find the start of coded differences as find_tokens, splitting the data
+   # into bands walked speculatively in parallel by given number of processes
+   def find_tokens_parallel(self, count, processes):
+      global shared_decoder
+      nc = self.components
+      # band boundaries (byte aligned), and overlap walked beyond each band
+      bounds = [(self.nbits * k // processes) & ~7 for k in range(processes)] + [self.nbits]
+      overlap = 1<<16
+      # starting components giving a distinct sequence of Huffman tables
+      phases = []
+      sequences = []
+      for first in range(nc):
+         order = self.get_table_sequence(first)
+         if order not in sequences:
+            sequences.append(order)
+            phases.append(first)
+      # walk the first band from the start, and the others speculatively from
+      # the band start with each distinct starting component
+      jobs = [(bounds[0], 0, bounds[1] + overlap)]
+      for k in range(1, processes):
+         jobs += [(bounds[k], first, bounds[k+1] + overlap) for first in phases]
+      # worker processes share this decoder (by forking)
+      shared_decoder = self
+      pool = multiprocessing.Pool(processes)
+      try:
+         results = pool.map(walk_band, jobs)
+      finally:
+         pool.terminate()
+         shared_decoder = None
+      # follow the true chain through each band, switching to a speculative
+      # chain once it is found to pass through the same position and component
+      chain = results[0]
+      parts = []
+      start = 0
+      first = 0
+      for k in range(processes):
+         if k > 0:
+            chains = zip(phases, results[1 + (k-1) * len(phases):1 + k * len(phases)])
+            chain = self.resync(start, first, chains, bounds[k+1])
+         # keep the part of the chain within this band
+         i = np.searchsorted(chain, bounds[k+1])
+         parts.append(chain[:i])
+         if i == len(chain):
+            break
+         start = int(chain[i])
+         first = (first + i) % nc
+      positions = np.concatenate(parts)
+      if count is not None:
+         positions = positions[:count]
+      return positions
+
+   # get sequence of Huffman tables used from given starting component
+   def get_table_sequence(self, first):
+      nc = self.components
+      return [id(self.tables[(first + i) % nc]) for i in range(nc)]
+
+   # get true chain from given position and component, joining the given
+   # speculative chains (starting component, positions) where possible, up to
+   # at least bit position 'end'
+   def resync(self, start, first, chains, end):
+      nc = self.components
+      # label each component by its sequence of Huffman tables, as chains
+      # with the same sequence from a position are the same from there on
+      sequences = [self.get_table_sequence(c) for c in range(nc)]
+      label = np.array([sequences.index(order) for order in sequences])
+      parts = []
+      while True:
+         # coded differences on the true chain, through the next block
+         p = self.find_tokens(None, start, first, start + self.chunk_bits)
+         if len(p) == 0:
+            break
+         phase = (first + np.arange(len(p))) % nc
+         for f, q in chains:
+            # positions on the true chain also found on this chain, with an
+            # equivalent component (the true component of the positions
+            # taken from it follows from their place in the joined chain)
+            i = np.minimum(np.searchsorted(q, p), len(q) - 1)
+            match = np.flatnonzero((q[i] == p) & (label[(f + i) % nc] == label[phase]))
+            if len(match):
+               j = match[0]
+               parts.append(p[:j])
+               parts.append(q[i[j]:])
+               return np.concatenate(parts)
+         parts.append(p)
+         if p[-1] >= end or start + self.chunk_bits >= self.nbits:
+            break
+         start = int(p[-1])
+         first = int(phase[-1])
+         parts[-1] = p[:-1]
+      return np.concatenate(parts)
+
+   # decode coded differences for the first given number of rows
+   def read_differences(self, rows, processes=None):
+      nc = self.components
+      count = rows * self.width * nc
+      # walk in parallel only for a whole image of some size
+      if processes > 1 and rows == self.height and self.nbits > processes * self.chunk_bits:
+         positions = self.find_tokens_parallel(count, processes)
+      else:
+         positions = self.find_tokens(count)
+      # make sure we did not run past the end of the data
+      if len(positions) < count:
+         raise ValueError('Unexpected end of data after %d differences' % len(positions))
+      # extract differences in blocks (whole units), to limit memory use
+      diff = np.empty(count, dtype=np.int32)
+      step = nc * (self.chunk_bits // 8)
+      for k in range(0, count, step):
+         for i in range(nc):
+            diff[k+i:k+step:nc] = self.get_differences(self.tables[i], positions[k+i:k+step:nc])
+      return diff.reshape(rows, self.width, nc)
+
+   # reconstruct samples from differences (array of rows x width x components)
+   def reconstruct(self, diff):
+      rows, width, nc = diff.shape
+      x = np.empty(diff.shape, dtype=np.int32)
+      # first row uses the sample to the left (Ra) and the default initial
+      # prediction; first column uses the sample above (Rb)
+      initial = 1 << (self.precision - self.point_transform - 1)
+      col = np.cumsum(diff[:,0,:], axis=0, dtype=np.int32) + initial
+      x[0,:,:] = np.cumsum(diff[0,:,:], axis=0, dtype=np.int32) + initial
+      x[:,0,:] = col
+      if rows > 1 and width > 1:
+         p = self.predictor
+         if p == 1: # Ra
+            d = diff[1:].copy()
+            d[:,0,:] = col[1:]
+            x[1:] = np.cumsum(d, axis=1, dtype=np.int32)
+         elif p == 2: # Rb
+            d = diff[1:,1:]
+            x[1:,1:] = np.cumsum(d, axis=0, dtype=np.int32) + x[0,1:]
+         else:
+            # remaining predictors need the previous row, so go row by row
+            for r in range(1, rows):
+               prev = x[r-1] & 0xffff
+               if p == 3: # Rc
+                  x[r,1:] = prev[:-1] + diff[r,1:]
+               elif p == 4: # Ra + Rb - Rc
+                  x[r,1:] = x[r,0] + np.cumsum(prev[1:] - prev[:-1] + diff[r,1:], axis=0, dtype=np.int32)
+               elif p == 5: # Ra + ((Rb - Rc) >> 1)
+                  x[r,1:] = x[r,0] + np.cumsum(((prev[1:] - prev[:-1]) >> 1) + diff[r,1:], axis=0, dtype=np.int32)
+               else: # Rb + ((Ra - Rc) >> 1) or (Ra + Rb) >> 1
+                  # these depend on the (reduced) sample to the left, so go
+                  # sample by sample (on lists, which is faster here)
+                  for i in range(nc):
+                     rb = prev[:,i].tolist()
+                     d = diff[r,:,i].tolist()
+                     row = [int(x[r,0,i]) & 0xffff]
+                     ra = row[0]
+                     for c in range(1, width):
+                        if p == 6:
+                           ra = (rb[c] + ((ra - rb[c-1]) >> 1) + d[c]) & 0xffff
+                        else:
+                           ra = (((ra + rb[c]) >> 1) + d[c]) & 0xffff
+                        row.append(ra)
+                     x[r,:,i] = row
+      # reduce modulo 2^16 and undo point transform
+      x &= 0xffff
+      if self.point_transform:
+         x <<= self.point_transform
+      return x
+
+   # decode image (or only the first given number of rows), optionally
+   # finding coded differences with given number of processes
+   # returns array of rows x (width*components), with interleaved components
+   def decode(self, rows=None, processes=None):
+      if rows is None:
+         rows = self.height
+      rows = min(rows, self.height)
+      x = self.reconstruct(self.read_differences(rows, processes))
+      return x.reshape(rows, self.width * self.components)
+
+## decoder shared with worker processes, and worker function for one band
+
+shared_decoder = None
+
+def walk_band(job):
+   start, first, end = job
+   return shared_decoder.find_tokens(None, start, first, end).astype(np.uint32)
+
+## decode lossless JPEG data (any object with buffer interface)
+## returns image with interleaved color components, number of components, and precision
+
+def decode(data, processes=None):
+   d = decoder(data)
+   a = d.decode(processes=processes).astype(np.dtype('>H'))
+   return a, d.components, d.precision
+
+## class for a lossless JPEG encoder
+
+class encoder():
+
+   # number of coded differences packed at once
+   chunk_samples = 1<<20
+
+   # get prediction for all samples (array of rows x width x components)
+   @staticmethod
+   def get_prediction(x, precision, predictor):
+      p = np.empty_like(x)
+      # first row uses the sample to the left (Ra) and the default initial
+      # prediction; first column uses the sample above (Rb)
+      p[0,0,:] = 1 << (precision - 1)
+      p[0,1:] = x[0,:-1]
+      p[1:,0] = x[:-1,0]
+      ra = x[1:,:-1]
+      rb = x[:-1,1:]
+      rc = x[:-1,:-1]
+      if predictor == 1:
+         p[1:,1:] = ra
+      elif predictor == 2:
+         p[1:,1:] = rb
+      elif predictor == 3:
+         p[1:,1:] = rc
+      elif predictor == 4:
+         p[1:,1:] = ra + rb - rc
+      elif predictor == 5:
+         p[1:,1:] = ra + ((rb - rc) >> 1)
+      elif predictor == 6:
+         p[1:,1:] = rb + ((ra - rc) >> 1)
+      elif predictor == 7:
+         p[1:,1:] = (ra + rb) >> 1
+      else:
+         raise ValueError('Unsupported predictor %d' % predictor)
+      return p
+
+   # pack codes of given lengths (up to 32 bits each) into a bitstream,
+   # padding the last byte with ones
+   @staticmethod
+   def pack_bits(codes, lengths, chunk_samples):
+      parts = []
+      carry = 0
+      pos = 0
+      for i in range(0, len(codes), chunk_samples):
+         code = codes[i:i+chunk_samples]
+         length = lengths[i:i+chunk_samples]
+         end = pos + np.cumsum(length)
+         start = end - length
+         # align each code within the five bytes starting at its first byte
+         value = code << (40 - (start & 7) - length)
+         index = (start >> 3) - (pos >> 3)
+         count = int(((end[-1] + 7) >> 3) - (pos >> 3))
+         # codes do not overlap, so adding bytes is the same as or-ing them
+         acc = np.zeros(count + 4, dtype=np.int64)
+         for j in range(5):
+            acc += np.bincount(index + j, weights=(value >> (32 - 8*j)) & 0xff,
+               minlength=count + 4).astype(np.int64)
+         acc[0] |= carry
+         pos = int(end[-1])
+         full = count - (1 if pos & 7 else 0)
+         parts.append(acc[:full].astype(np.uint8))
+         carry = acc[full] if pos & 7 else 0
+      if pos & 7:
+         parts.append(np.array([carry | ((1 << (8 - (pos & 7))) - 1)], dtype=np.uint8))
+      if not parts:
+         return np.zeros(0, dtype=np.uint8)
+      return np.concatenate(parts)
+
+   # initialize with image parameters
+   def __init__(self, components, precision, predictor=1):
+      self.components = components
+      self.precision = precision
+      self.predictor = predictor
+      return
+
+   # encode image with interleaved color components (array of rows x
+   # (width*components)), returning the encoded data
+   def encode(self, a):
+      nc = self.components
+      height, width = a.shape
+      assert width % nc == 0
+      width //= nc
+      x = a.astype(np.int32, copy=False).reshape(height, width, nc)
+      if (x >> self.precision).any():
+         raise ValueError('Sample values exceed precision of %d bits' % self.precision)
+      # differences from prediction, modulo 2^16 (range -32767 to 32768)
+      diff = x - encoder.get_prediction(x, self.precision, self.predictor)
+      diff &= 0xffff
+      diff[diff >= 32768] -= 65536
+      # difference category (number of additional bits, except 16)
+      ssss = np.frexp(np.abs(diff))[1].astype(np.int64)
+      # optimal Huffman table for each component (one shared table if
+      # there are more components than table identifiers)
+      if nc <= 4:
+         tables = [huffman_table.from_frequencies(np.bincount(ssss[:,:,i].ravel(), minlength=17)) \
+            for i in range(nc)]
+         table_index = range(nc)
+      else:
+         tables = [huffman_table.from_frequencies(np.bincount(ssss.ravel(), minlength=17))]
+         table_index = [0] * nc
+      code = np.array([tables[t].code for t in table_index])
+      size = np.array([tables[t].size for t in table_index])
+      # coded difference: Huffman code followed by additional bits
+      i = np.arange(nc)
+      n = np.where(ssss == 16, 0, ssss)
+      extra = np.where(diff < 0, diff + (1 << n) - 1, diff) & ((1 << n) - 1)
+      codes = ((code[i,ssss] << n) | extra).ravel()
+      lengths = (size[i,ssss] + n).ravel()
+      del diff, ssss, n, extra
+      ecs = encoder.pack_bits(codes, lengths, self.chunk_samples)
+      # stuff a zero byte after each 0xff
+      ff = np.flatnonzero(ecs == 0xff)
+      ecs = np.insert(ecs, ff + 1, 0)
+      # assemble headers and data
+      out = [struct.pack('>BB', 0xff, SOI)]
+      for t, table in enumerate(tables):
+         segment = table.get_segment(t)
+         out.append(struct.pack('>BBH', 0xff, DHT, len(segment) + 2) + segment)
+      segment = struct.pack('>BHHB', self.precision, height, width, nc)
+      for c in range(nc):
+         segment += struct.pack('BBB', c+1, 0x11, 0)
+      out.append(struct.pack('>BBH', 0xff, SOF3, len(segment) + 2) + segment)
+      segment = struct.pack('B', nc)
+      for c in range(nc):
+         segment += struct.pack('BB', c+1, table_index[c] << 4)
+      segment += struct.pack('BBB', self.predictor, 0, 0)
+      out.append(struct.pack('>BBH', 0xff, SOS, len(segment) + 2) + segment)
+      out.append(ecs.tostring())
+      out.append(struct.pack('>BB', 0xff, EOI))
+      return ''.join(out)
+
+## encode image with interleaved color components to lossless JPEG data
+
+def encode(a, components, precision, predictor=1):
+   return encoder(components, precision, predictor).encode(a)
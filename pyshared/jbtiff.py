@@ -18,13 +18,21 @@
 # You should have received a copy of the GNU General Public License
 # along with CR2_Scripts.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import os
+import mmap
+import bisect
 import struct
+import shutil
+import tempfile
+import cPickle
+import collections
 import numpy as np
 
 class value_range():
 
    # initialize as blank sequence
+   # (data is kept as a sorted list of disjoint, non-adjacent (lo,hi) spans)
    def __init__(self):
       self.data = []
       return
@@ -32,16 +40,17 @@ class value_range():
    # add range of numbers, both inclusive
    def add_range(self, lo, hi):
       assert lo <= hi
-      # find insertion point
-      index = len(self.data)
-      for i, (a,b) in enumerate(self.data):
-         if lo <= b:
-            index = i
-            break
-      # insert as new range
-      self.data.insert(index, (lo,hi))
-      # now flatten the existing range
-      self.flatten()
+      # find first span that ends at or after lo-1 (i.e. touching new range)
+      i = bisect.bisect_left(self.data, (lo,))
+      if i > 0 and self.data[i-1][1] >= lo-1:
+         i -= 1
+      # find first span that starts after hi+1 (i.e. beyond new range)
+      j = bisect.bisect_left(self.data, (hi+2,))
+      # merge with any spans in between
+      if i < j:
+         lo = min(lo, self.data[i][0])
+         hi = max(hi, self.data[j-1][1])
+      self.data[i:j] = [(lo,hi)]
       return
 
    # add ranges of numbers from another set
@@ -54,33 +63,24 @@ class value_range():
    # subtract range of numbers, both inclusive
    def sub_range(self, lo, hi):
       assert lo <= hi
+      # find first span that ends at or after lo
+      i = bisect.bisect_left(self.data, (lo,))
+      if i > 0 and self.data[i-1][1] >= lo:
+         i -= 1
+      # find first span that starts after hi
+      j = bisect.bisect_left(self.data, (hi+1,))
+      # nothing to do if no spans are affected
+      if i >= j:
+         return
+      # keep initial and final parts that are not erased
       tmp = []
-      # copy over existing spans, editing as needed
-      for a,b in self.data:
-         # unaffected span
-         if b < lo or a > hi:
-            tmp.append((a,b))
-            continue
-         # completely subtracted span
-         if a >= lo and b <= hi:
-            continue
-         # interior part erased
-         if a < lo and b > hi:
-            tmp.append((a, lo-1))
-            tmp.append((hi+1, b))
-            continue
-         # initial part erased
-         if a < lo:
-            tmp.append((a, lo-1))
-            continue
-         # final part erased
-         if b > hi:
-            tmp.append((hi+1, b))
-            continue
-         # catch-all
-         raise AssertionError("Unhandled situation: remove %s from %s" % ((lo,hi), (a,b)))
-      # replace table with new version
-      self.data = tmp
+      a, b = self.data[i]
+      if a < lo:
+         tmp.append((a, lo-1))
+      a, b = self.data[j-1]
+      if b > hi:
+         tmp.append((hi+1, b))
+      self.data[i:j] = tmp
       return
 
    # subtract ranges of numbers from another set
@@ -91,10 +91,11 @@ class value_range():
       return
 
    # flatten sequence of ranges into shortest expression
+   # (only needed if data was modified directly)
    def flatten(self):
       tmp = []
       span = None
-      for a,b in self.data:
+      for a,b in sorted(self.data):
          # nothing there yet
          if not span:
             span = (a,b)
@@ -107,15 +108,214 @@ class value_range():
          tmp.append(span)
          span = (a,b)
       # write last entry
-      tmp.append(span)
+      if span:
+         tmp.append(span)
       # replace table with flattened version
       self.data = tmp
       return
 
+   # return span containing given number, or None
+   def find(self, x):
+      i = bisect.bisect_right(self.data, (x, sys.maxint))
+      if i > 0 and self.data[i-1][1] >= x:
+         return self.data[i-1]
+      return None
+
+   # check if given number is in set
+   def contains(self, x):
+      return self.find(x) is not None
+
+   # check if range of numbers, both inclusive, is entirely in set
+   def covers(self, lo, hi):
+      assert lo <= hi
+      span = self.find(lo)
+      return span is not None and span[1] >= hi
+
+   # check if any part of range of numbers, both inclusive, is in set
+   def overlaps(self, lo, hi):
+      assert lo <= hi
+      i = bisect.bisect_left(self.data, (hi+1,))
+      return i > 0 and self.data[i-1][1] >= lo
+
    # display overall range used
    def display(self):
       return ', '.join(['%d-%d' % (a,b) if b>a else '%d' % a for a,b in self.data])
 
+## class to look up the objects covering any given offset
+
+class range_map():
+
+   # initialize from a list of (offset, length, description) items
+   def __init__(self, items):
+      # split the number line into segments wherever an object starts or ends
+      self.points = sorted(set([offset for offset, length, description in items] + \
+                               [offset+length for offset, length, description in items]))
+      # list the objects covering each segment
+      self.objects = [[] for p in self.points]
+      for offset, length, description in sorted(items):
+         i = bisect.bisect_left(self.points, offset)
+         j = bisect.bisect_left(self.points, offset+length)
+         for k in range(i,j):
+            self.objects[k].append((offset, length, description))
+      return
+
+   # return list of (offset, length, description) items covering given offset
+   def find(self, x):
+      k = bisect.bisect_right(self.points, x) - 1
+      if k < 0:
+         return []
+      return self.objects[k]
+
+## load tag names from text file
+
+def read_tag_names(fid):
+   tag_name = {}
+   for line in fid:
+      # skip comments
+      if line.startswith('#'):
+         continue
+      record = line.split('\t')
+      parent = int(record[0])
+      tag = int(record[1])
+      name = record[3]
+      tag_name[(parent,tag)] = name
+   return tag_name
+
+## load color table from text file
+
+# XYZ to RGB conversion
+xyz_rgb = np.array([[ 0.412453, 0.357580, 0.180423 ],
+                    [ 0.212671, 0.715160, 0.072169 ],
+                    [ 0.019334, 0.119193, 0.950227 ]])
+
+def read_color_table(fid):
+   # keep entries in file order, for prefix matching
+   color_table = collections.OrderedDict()
+   for line in fid:
+      # skip comments
+      if line.startswith('#'):
+         continue
+      record = line.split('\t')
+      name = record[0]
+      t_black = int(record[1], 0)
+      t_maximum = int(record[2], 0)
+      trans = [int(x)/10000.0 for x in record[3:]]
+      # handle only 3-color transforms
+      if len(trans) == 9:
+         cam_xyz = np.array(trans).reshape((3,3))
+         cam_rgb = np.dot(cam_xyz, xyz_rgb)
+         # precompute inverse transform (camera to linear sRGB)
+         rgb_cam = np.linalg.pinv(cam_rgb)
+         color_table[name] = [t_black, t_maximum, cam_rgb, rgb_cam]
+   return color_table
+
+## class for a table read from a text file on first use
+## (the parsed table is cached in binary form alongside the text file, and
+## reused for as long as the text file is unchanged)
+
+class lazy_table(collections.Mapping):
+
+   # cache format version, to be updated whenever the parsed content changes
+   version = 2
+
+   # initialize with text file and function to parse it
+   def __init__(self, filename, parser):
+      self.filename = filename
+      self.parser = parser
+      self.table = None
+      return
+
+   # read table from cache if it is up to date, or from text file otherwise
+   def load(self):
+      stat = os.stat(self.filename)
+      key = (lazy_table.version, stat.st_mtime, stat.st_size)
+      cachefile = os.path.splitext(self.filename)[0] + '.cache'
+      try:
+         with open(cachefile, 'rb') as fid:
+            cached_key, table = cPickle.load(fid)
+         if cached_key == key:
+            return table
+      except Exception:
+         # missing or unreadable cache, so ignore it
+         pass
+      # parse text file
+      with open(self.filename, 'r') as fid:
+         table = self.parser(fid)
+      # update cache, replacing any previous one atomically
+      try:
+         fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+         with os.fdopen(fd, 'wb') as fid:
+            cPickle.dump((key, table), fid, cPickle.HIGHEST_PROTOCOL)
+         os.rename(tmpfile, cachefile)
+      except (IOError, OSError):
+         # cache location is not writable, so do without
+         pass
+      return table
+
+   # get table, loading it if necessary
+   def get_table(self):
+      if self.table is None:
+         self.table = self.load()
+      return self.table
+
+   def __getitem__(self, key):
+      return self.get_table()[key]
+
+   def __iter__(self):
+      return iter(self.get_table())
+
+   def __len__(self):
+      return len(self.get_table())
+
+## class for a data strip held in a file, accessed without reading it into memory
+
+class file_strip():
+
+   # initialize as view of given length at given offset of stream
+   # (the stream is mapped read-only, unless a mapping is given; length
+   # defaults to the rest of the stream)
+   def __init__(self, fid, offset=0, length=None, map=None):
+      # keep a reference to the stream, so that it stays open
+      self.fid = fid
+      if map is None:
+         map = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+      self.map = map
+      # limit view to what is actually in the stream
+      if length is None:
+         length = len(map) - offset
+      self.offset = offset
+      self.length = max(0, min(length, len(map) - offset))
+      return
+
+   # length of strip, in bytes
+   def __len__(self):
+      return self.length
+
+   # return a zero-copy view for slices, or the byte at given index
+   def __getitem__(self, key):
+      if isinstance(key, slice):
+         start, stop, step = key.indices(self.length)
+         assert step == 1
+         return file_strip(self.fid, self.offset + start, stop - start, self.map)
+      if key < 0:
+         key += self.length
+      if key < 0 or key >= self.length:
+         raise IndexError("strip index out of range")
+      return self.map[self.offset + key]
+
+   # return copy of strip content
+   def __str__(self):
+      return self.map[self.offset:self.offset + self.length]
+
+   # return zero-copy buffer object for strip content
+   def get_buffer(self):
+      return buffer(self.map, self.offset, self.length)
+
+   # write strip content to stream, directly from mapped file
+   def write_to(self, fid):
+      fid.write(buffer(self.map, self.offset, self.length))
+      return
+
 class tiff_file():
 
    ## constants
@@ -150,53 +350,155 @@ class tiff_file():
       12: 'DOUBLE',
       }
 
-   tag_name = {}
-   # load tag names from text file
-   dirname = os.path.dirname(os.path.abspath(__file__))
-   for line in open(os.path.join(dirname,'tiff-tags.txt'),'r'):
-      # skip comments
-      if line.startswith('#'):
-         continue
-      record = line.split('\t')
-      parent = int(record[0])
-      tag = int(record[1])
-      name = record[3]
-      tag_name[(parent,tag)] = name
+   # struct format character for each field type (rationals are pairs)
+   field_format = {
+      1: 'B', # BYTE
+      2: 's', # ASCII
+      3: 'H', # SHORT
+      4: 'L', # LONG
+      5: 'L', # RATIONAL
+      6: 'b', # SBYTE
+      7: 'B', # UNDEFINED
+      8: 'h', # SSHORT
+      9: 'l', # SLONG
+      10: 'l', # SRATIONAL
+      11: 'f', # FLOAT
+      12: 'd', # DOUBLE
+      }
+
+   # precompiled IFD entry structure for each byte order
+   entry_struct = {
+      '<': struct.Struct('<HHL4s'),
+      '>': struct.Struct('>HHL4s'),
+      }
+
+   # precompiled structures for SHORT and LONG words, for each byte order
+   short_struct = {
+      '<': struct.Struct('<H'),
+      '>': struct.Struct('>H'),
+      }
+   long_struct = {
+      '<': struct.Struct('<L'),
+      '>': struct.Struct('>L'),
+      }
 
    # XYZ to RGB conversion
-   xyz_rgb = np.array([[ 0.412453, 0.357580, 0.180423 ],
-                       [ 0.212671, 0.715160, 0.072169 ],
-                       [ 0.019334, 0.119193, 0.950227 ]])
-   color_table = {}
-   # load color table from text file
-   for line in open(os.path.join(dirname,'raw-color-coeff.txt'),'r'):
-      # skip comments
-      if line.startswith('#'):
-         continue
-      record = line.split('\t')
-      name = record[0]
-      t_black = eval(record[1])
-      t_maximum = eval(record[2])
-      trans = [int(x)/10000.0 for x in record[3:]]
-      # handle only 3-color transforms
-      if len(trans) == 9:
-         cam_xyz = np.array(trans).reshape((3,3))
-         cam_rgb = np.dot(cam_xyz, xyz_rgb)
-         color_table[name] = [t_black, t_maximum, cam_rgb]
+   xyz_rgb = xyz_rgb
+
+   # tag names and color table are loaded on first use
+   dirname = os.path.dirname(os.path.abspath(__file__))
+   tag_name = lazy_table(os.path.join(dirname,'tiff-tags.txt'), read_tag_names)
+   color_table = lazy_table(os.path.join(dirname,'raw-color-coeff.txt'), read_color_table)
+
+   # index of color table by normalized model name, built on first use
+   color_index = None
+   # color profiles already looked up, by model name as given
+   color_lookup = {}
+   # sRGB gamma lookup tables already computed, by number of index bits
+   srgb_gamma_luts = {}
+   srgb_gamma_inverse_luts = {}
 
    ## class functions
 
+   # normalize camera model name for color table lookup
+   @staticmethod
+   def normalize_model(model):
+      # ignore trailing NULs, repeated whitespace, and case
+      model = ' '.join(model.strip('\x00').split()).lower()
+      # ignore manufacturer prefix
+      if model.startswith('canon '):
+         model = model[len('canon '):]
+      return model
+
+   # get color profile [black, maximum, cam_rgb, rgb_cam] for camera model
+   # (model names are matched after normalization, or failing that, as in
+   # dcraw, with the first table entry that is a prefix of the model name)
+   @staticmethod
+   def get_color_profile(model):
+      # use earlier result if present
+      if model in tiff_file.color_lookup:
+         return tiff_file.color_lookup[model]
+      # build index, keeping the first entry for any normalized name
+      if tiff_file.color_index is None:
+         index = collections.OrderedDict()
+         for name in tiff_file.color_table:
+            index.setdefault(tiff_file.normalize_model(name), name)
+         tiff_file.color_index = index
+      # look for exact match first, then for a prefix match
+      key = tiff_file.normalize_model(model)
+      name = tiff_file.color_index.get(key)
+      if name is None:
+         for prefix, candidate in tiff_file.color_index.iteritems():
+            if key.startswith(prefix):
+               name = candidate
+               break
+      if name is None:
+         raise KeyError("No color profile for camera model '%s'" % model.strip('\x00'))
+      print "Using color profile for '%s'" % name
+      tiff_file.color_lookup[model] = tiff_file.color_table[name]
+      return tiff_file.color_lookup[model]
+
    # transform linear RGB values to gamma-corrected sRGB values
+   # (evaluating each part of the curve only where it applies)
    @staticmethod
    def srgb_gamma(r):
-      return (r <= 0.0031308) * (12.92 * r) + \
-             (r >  0.0031308) * (1.055 * pow(r,1/2.4) - 0.055)
+      r = np.asarray(r)
+      if r.dtype.kind != 'f':
+         r = r.astype(float)
+      mask = r > 0.0031308
+      out = np.multiply(r, 12.92, out=np.empty_like(r))
+      out[mask] = 1.055 * np.power(r[mask], 1/2.4) - 0.055
+      return out
 
    # transform gamma-corrected sRGB values to linear RGB values
+   # (evaluating each part of the curve only where it applies)
    @staticmethod
    def srgb_gamma_inverse(r):
-      return (r <= 0.04045) * (r / 12.92) + \
-             (r >  0.04045) * pow((r+0.055)/1.055,2.4)
+      r = np.asarray(r)
+      if r.dtype.kind != 'f':
+         r = r.astype(float)
+      mask = r > 0.04045
+      out = np.divide(r, 12.92, out=np.empty_like(r))
+      out[mask] = np.power((r[mask] + 0.055) / 1.055, 2.4)
+      return out
+
+   # get table of gamma-corrected sRGB values quantized to 16 bits, for
+   # linear RGB values in [0.0,1.0] in 2^bits steps
+   @staticmethod
+   def get_srgb_gamma_lut(bits=20):
+      lut = tiff_file.srgb_gamma_luts.get(bits)
+      if lut is None:
+         r = np.arange(1<<bits) / float((1<<bits)-1)
+         lut = (tiff_file.srgb_gamma(r) * ((1<<16)-1)).astype(np.uint16)
+         tiff_file.srgb_gamma_luts[bits] = lut
+      return lut
+
+   # get table of linear RGB values for gamma-corrected sRGB levels of given
+   # bit depth
+   @staticmethod
+   def get_srgb_gamma_inverse_lut(depth):
+      lut = tiff_file.srgb_gamma_inverse_luts.get(depth)
+      if lut is None:
+         r = np.arange(1<<depth) / float((1<<depth)-1)
+         lut = tiff_file.srgb_gamma_inverse(r)
+         tiff_file.srgb_gamma_inverse_luts[depth] = lut
+      return lut
+
+   # transform linear RGB values in [0.0,1.0] to gamma-corrected sRGB values
+   # quantized to 16 bits, with a single table lookup
+   @staticmethod
+   def srgb_gamma_quantize(r, bits=20):
+      index = np.empty(r.shape, dtype=np.intp)
+      np.rint(r * ((1<<bits)-1), out=index, casting='unsafe')
+      return tiff_file.get_srgb_gamma_lut(bits)[index]
+
+   # transform gamma-corrected sRGB levels (integers of given bit depth) to
+   # linear RGB values in [0.0,1.0] of given float type, with a single table
+   # lookup
+   @staticmethod
+   def srgb_gamma_inverse_lookup(a, depth, dtype=float):
+      lut = tiff_file.get_srgb_gamma_inverse_lut(depth)
+      return lut.astype(dtype, copy=False)[a]
 
    # return value aligned to word boundary (increasing as necessary)
    @staticmethod
@@ -293,6 +595,43 @@ class tiff_file():
       fid.write(buf)
       return
 
+   # get struct byte order prefix for given endianness
+   @staticmethod
+   def get_byte_order(little_endian):
+      if little_endian:
+         return '<'
+      return '>'
+
+   # decode array of values of given field type from raw bytes
+   @staticmethod
+   def unpack_values(field_type, value_count, data, little_endian):
+      # ASCII strings are kept as they are
+      if field_type == 2:
+         return data
+      # set up endianness
+      fmt = tiff_file.get_byte_order(little_endian)
+      # rationals are pairs of words
+      if field_type in (5, 10):
+         values = struct.unpack(fmt + '%d%s' % (2*value_count, tiff_file.field_format[field_type]), data)
+         return zip(values[0::2], values[1::2])
+      # everything else is a sequence of single words
+      values = struct.unpack(fmt + '%d%s' % (value_count, tiff_file.field_format[field_type]), data)
+      return list(values)
+
+   # encode array of values of given field type as raw bytes
+   @staticmethod
+   def pack_values(field_type, values, little_endian):
+      # ASCII strings are kept as they are
+      if field_type == 2:
+         return values
+      # set up endianness
+      fmt = tiff_file.get_byte_order(little_endian)
+      # rationals are pairs of words
+      if field_type in (5, 10):
+         values = [x for value in values for x in value]
+      # convert to a sequence of words
+      return struct.pack(fmt + '%d%s' % (len(values), tiff_file.field_format[field_type]), *values)
+
    # get tags with strip offset and length from IFD
    @staticmethod
    def get_strip_parameters(IFD):
@@ -353,9 +692,21 @@ class tiff_file():
          return sensor[1], sensor[2]
       return None
 
+   # get index of RAW IFD: the one with slice information, or IFD#3 in a CR2
+   # file without it; None if not found
+   def get_raw_ifd(self):
+      for k, (IFD, ifd_offset, strips) in enumerate(self.data):
+         if 50752 in IFD:
+            return k
+      if self.cr2 and len(self.data) > 3:
+         return 3
+      return None
+
    # get slice information from RAW IFD, if present
    def get_slices(self):
-      ifd_index = 3
+      ifd_index = self.get_raw_ifd()
+      if ifd_index is None:
+         return None
       IFD = self.data[ifd_index][0]
       if self.cr2 and 50752 in IFD:
          slices = IFD[50752][2]
@@ -375,6 +726,72 @@ class tiff_file():
          return tuple(sensor[5:9])
       return None
 
+   # get uncompressed RGB image from given IFD (e.g. IFD#2 in CR2 files), as
+   # an array of rows x columns x 3 that refers to the strip data directly
+   def get_rgb_image(self, ifd_index):
+      IFD = self.data[ifd_index][0]
+      assert 277 not in IFD or IFD[277][2][0] == 3
+      w,h = self.get_image_size(ifd_index)
+      depth = self.get_image_depth(ifd_index)
+      assert depth in [8, 16]
+      dtype = np.dtype(tiff_file.get_byte_order(self.little_endian) + ('u1' if depth == 8 else 'u2'))
+      a = np.frombuffer(self.get_data(ifd_index), dtype=dtype, count=w*h*3)
+      return a.reshape(h, w, 3)
+
+   # map stream into memory (read-only), or return None if it cannot be
+   # mapped (e.g. a pipe or an empty file)
+   @staticmethod
+   def map_stream(fid):
+      try:
+         return mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+      except (AttributeError, IOError, ValueError, mmap.error):
+         return None
+
+   # map input stream into memory if possible
+   # (otherwise strips are read directly)
+   def map_file(self, fid):
+      self.map = tiff_file.map_stream(fid)
+      return
+
+   # get whole content of stream as a data strip, as a zero-copy view if it
+   # can be mapped
+   @staticmethod
+   def read_strip(fid):
+      map = tiff_file.map_stream(fid)
+      if map is not None:
+         return file_strip(fid, 0, None, map)
+      return fid.read()
+
+   # get data strip at given offset, as a zero-copy view if file is mapped
+   def get_strip(self, fid, strip_offset, strip_length):
+      if self.map is not None:
+         return file_strip(fid, strip_offset, strip_length, self.map)
+      fid.seek(strip_offset)
+      return fid.read(strip_length)
+
+   # return buffer for data strip content, whether held in memory or in a file
+   @staticmethod
+   def get_buffer(strip):
+      if isinstance(strip, file_strip):
+         return strip.get_buffer()
+      return strip
+
+   # get data held in strips of given IFD, as a single buffer
+   def get_data(self, k):
+      IFD, ifd_offset, strips = self.data[k]
+      if len(strips) == 1:
+         return tiff_file.get_buffer(strips[0])
+      return ''.join([str(tiff_file.get_buffer(strip)) for strip in strips])
+
+   # write data strip to stream, whether held in memory or in a file
+   @staticmethod
+   def write_strip(fid, strip):
+      if isinstance(strip, file_strip):
+         strip.write_to(fid)
+      else:
+         fid.write(strip)
+      return
+
    # read TIFF header
    def read_tiff_header(self, fid, spans):
       # determine byte order
@@ -421,49 +838,27 @@ class tiff_file():
       entry_count = tiff_file.read_word(fid, 2, False, self.little_endian)
       # add IFD bytes
       spans.add_range(ifd_offset, ifd_offset + 2 + entry_count*12 + 4 - 1)
-      # read IFD entries
+      # read all IFD entries in one go
+      buf = fid.read(entry_count*12)
+      entry = tiff_file.entry_struct[tiff_file.get_byte_order(self.little_endian)]
+      # decode IFD entries
       IFD = {}
       for i in range(entry_count):
-         # make sure we're in the correct position
-         fid.seek(ifd_offset + 2 + i*12)
          # get IFD entry information
-         tag = tiff_file.read_word(fid, 2, False, self.little_endian)
-         field_type = tiff_file.read_word(fid, 2, False, self.little_endian)
-         value_count = tiff_file.read_word(fid, 4, False, self.little_endian)
+         tag, field_type, value_count, value_field = entry.unpack_from(buf, i*12)
          # check if the value fits here or if we need offset
          value_offset = None
-         if self.field_size[field_type] * value_count > 4:
-            value_offset = tiff_file.read_word(fid, 4, False, self.little_endian)
+         length = self.field_size[field_type] * value_count
+         if length > 4:
+            value_offset = tiff_file.unpack_values(4, 1, value_field, self.little_endian)[0]
             fid.seek(value_offset)
+            data = fid.read(length)
             # add value bytes
-            spans.add_range(value_offset, value_offset + self.field_size[field_type] * value_count - 1)
-         # read value(s)
-         if field_type == 1: # BYTE
-            values = [tiff_file.read_word(fid, 1, False, self.little_endian) for j in range(value_count)]
-         elif field_type == 2: # ASCII
-            values = fid.read(value_count)
-         elif field_type == 3: # SHORT
-            values = [tiff_file.read_word(fid, 2, False, self.little_endian) for j in range(value_count)]
-         elif field_type == 4: # LONG
-            values = [tiff_file.read_word(fid, 4, False, self.little_endian) for j in range(value_count)]
-         elif field_type == 5: # RATIONAL
-            values = [(tiff_file.read_word(fid, 4, False, self.little_endian), \
-                       tiff_file.read_word(fid, 4, False, self.little_endian)) for j in range(value_count)]
-         elif field_type == 6: # SBYTE
-            values = [tiff_file.read_word(fid, 1, True, self.little_endian) for j in range(value_count)]
-         elif field_type == 7: # UNDEFINED
-            values = [tiff_file.read_word(fid, 1, False, self.little_endian) for j in range(value_count)]
-         elif field_type == 8: # SSHORT
-            values = [tiff_file.read_word(fid, 2, True, self.little_endian) for j in range(value_count)]
-         elif field_type == 9: # SLONG
-            values = [tiff_file.read_word(fid, 4, True, self.little_endian) for j in range(value_count)]
-         elif field_type == 10: # SRATIONAL
-            values = [(tiff_file.read_word(fid, 4, True, self.little_endian), \
-                       tiff_file.read_word(fid, 4, True, self.little_endian)) for j in range(value_count)]
-         elif field_type == 11: # FLOAT
-            values = [tiff_file.read_float(fid, 4, self.little_endian) for j in range(value_count)]
-         elif field_type == 12: # DOUBLE
-            values = [tiff_file.read_float(fid, 8, self.little_endian) for j in range(value_count)]
+            spans.add_range(value_offset, value_offset + length - 1)
+         else:
+            data = value_field[:length]
+         # decode value(s)
+         values = tiff_file.unpack_values(field_type, value_count, data, self.little_endian)
          # store entry in IFD table with original offset if present
          IFD[tag] = (field_type, value_count, values, value_offset)
       # recursively read sub directories as needed
@@ -485,10 +880,13 @@ class tiff_file():
       # return directory
       return IFD
 
-   # initialize class from stream
-   def __init__(self, fid):
+   # initialize class from stream, reading only headers and directories
+   # (set verify to also check the content of unused parts of the file)
+   def __init__(self, fid, verify=False):
       # keep track of range of bytes read
       spans = value_range()
+      # set up lazy access to data strips
+      self.map_file(fid)
       # check if this is a TIFF file
       self.read_tiff_header(fid, spans)
       # initialize pointer to next IFD offset
@@ -498,6 +896,7 @@ class tiff_file():
       # initialize IFD table
       self.data = []
       # read all IFDs and associated strips in file
+      # (strips are views into the mapped file, so no data is read yet)
       while True:
          # get offset to IFD
          fid.seek(offset_ptr)
@@ -516,32 +915,45 @@ class tiff_file():
          strip_lengths = IFD[tag_length][2]
          assert len(strip_offsets) == len(strip_lengths)
          for strip_offset, strip_length in zip(strip_offsets, strip_lengths):
-            fid.seek(strip_offset)
-            strips.append(fid.read(strip_length))
+            strips.append(self.get_strip(fid, strip_offset, strip_length))
             spans.add_range(strip_offset, strip_offset + strip_length - 1)
          # store IFD, original offset, and data strips in table
          self.data.append((IFD, ifd_offset, strips))
+      # keep range of bytes used, for later verification
+      self.spans = spans
+      # check unused parts of file, if requested
+      if verify:
+         self.verify(fid)
+      return
+
+   # determine and check content of byte ranges not used by any object
+   def verify(self, fid):
       # display range of bytes used
-      print "Bytes read:", spans.display()
+      print "Bytes read:", self.spans.display()
       # determine file size
       fid.seek(0, 2)
       fsize = fid.tell()
       # determine range of bytes unused
       unused = value_range()
       unused.add_range(0, fsize-1)
-      unused.sub_ranges(spans)
+      unused.sub_ranges(self.spans)
       # display range of bytes unused
       print "Bytes not read:", unused.display()
       # check content of unused ranges
+      nonzero = []
       for i, (a,b) in enumerate(unused.data):
          # read data segment
-         fid.seek(a)
          n = b-a+1
-         data = fid.read(n)
+         if self.map is not None:
+            data = buffer(self.map, a, n)
+         else:
+            fid.seek(a)
+            data = fid.read(n)
          # check if it's all-zero
-         if not all([x=='\0' for x in data]):
+         if np.frombuffer(data, dtype=np.uint8).any():
             print "Non-zero data at %d, length %d" % (a,n)
-      return
+            nonzero.append((a,n))
+      return nonzero
 
    # determine written length of TIFF directory, including end alignment
    def get_directory_length(self, IFD):
@@ -561,137 +973,101 @@ class tiff_file():
       # done
       return tiff_file.align(length)
 
-   # write TIFF header
-   def write_tiff_header(self, fid):
-      fid.seek(0)
+   # write TIFF header into buffer
+   def write_tiff_header(self, buf):
+      order = tiff_file.get_byte_order(self.little_endian)
       # byte order
       if self.little_endian:
-         fid.write('II')
+         buf[0:2] = 'II'
       else:
-         fid.write('MM')
+         buf[0:2] = 'MM'
       # TIFF identifier
-      tiff_file.write_word(42, fid, 2, False, self.little_endian)
+      tiff_file.short_struct[order].pack_into(buf, 2, 42)
       # return pointers to IFD space and to offset
       return 8, 4
 
-   # write CR2 header if necessary
-   def write_cr2_header(self, fid, free_ptr):
+   # write CR2 header into buffer if necessary
+   def write_cr2_header(self, buf, free_ptr):
       # make sure this is a CR2 file
       if not self.cr2:
          return free_ptr, None
       # go to start of CR2 header
       assert free_ptr == 8
-      fid.seek(free_ptr)
-      # write CR2 magic word and version
-      fid.write('CR')
-      tiff_file.write_word(self.cr2_major, fid, 1, False, self.little_endian)
-      tiff_file.write_word(self.cr2_minor, fid, 1, False, self.little_endian)
-      tiff_file.write_word(0, fid, 4, False, self.little_endian) # space for CR2 IFD offset
+      # write CR2 magic word and version (leaving space for CR2 IFD offset)
+      buf[free_ptr:free_ptr+4] = 'CR' + chr(self.cr2_major) + chr(self.cr2_minor)
       return free_ptr+8, free_ptr+4
 
-   # write TIFF directory, starting at given offset
-   def write_directory(self, IFD, fid, ifd_offset):
+   # write TIFF directory into buffer, starting at given offset
+   def write_directory(self, IFD, buf, ifd_offset):
+      order = tiff_file.get_byte_order(self.little_endian)
+      entry = tiff_file.entry_struct[order]
       # write number of IFD entries
-      fid.seek(ifd_offset)
       entry_count = len(IFD)
-      tiff_file.write_word(entry_count, fid, 2, False, self.little_endian)
+      tiff_file.short_struct[order].pack_into(buf, ifd_offset, entry_count)
       # update pointer to offset and to next free space
       offset_ptr = ifd_offset + 2 + entry_count*12
       free_ptr = tiff_file.align(offset_ptr + 4)
-      # write any subdirectories present
+      # write any subdirectories present, keeping their entry details to write later
+      subdirectories = {}
       for tag in [34665, 34853, 37500, 40965]: # EXIF, GPS, MakerNote, Interoperability
          if tag in IFD:
             # read original entry details (values contains subdirecttory)
             field_type, value_count, values, value_offset = IFD[tag]
             # write subdirectory at next available space
             value_offset = free_ptr
-            sub_offset_ptr, free_ptr = self.write_directory(values, fid, value_offset)
-            # update entries for this subdirectory, based on field type, to write later
+            sub_offset_ptr, free_ptr = self.write_directory(values, buf, value_offset)
+            # determine entry for this subdirectory, based on field type
             if field_type == 4:
-               IFD[tag] = (field_type, value_count, [value_offset], None)
+               value_count = 1
             elif field_type == 7:
                value_count = free_ptr - value_offset
-               IFD[tag] = (field_type, value_count, None, value_offset)
             else:
                raise ValueError('Unsupported field type: %d' % field_type)
+            subdirectories[tag] = (value_count, value_offset)
       # write IFD entries
       for i, (tag, (field_type, value_count, values, value_offset)) in enumerate(sorted(IFD.iteritems())):
-         # make sure we're in the correct position
-         fid.seek(ifd_offset + 2 + i*12)
-         # write IFD entry information
-         tiff_file.write_word(tag, fid, 2, False, self.little_endian)
-         tiff_file.write_word(field_type, fid, 2, False, self.little_endian)
          # write entry information directly where value was written as subdirectory
-         if not values:
-            tiff_file.write_word(value_count, fid, 4, False, self.little_endian)
-            tiff_file.write_word(value_offset, fid, 4, False, self.little_endian)
+         if tag in subdirectories:
+            value_count, value_offset = subdirectories[tag]
+            entry.pack_into(buf, ifd_offset + 2 + i*12, tag, field_type, value_count, \
+               tiff_file.long_struct[order].pack(value_offset))
             continue
          # check count
          assert value_count == len(values)
-         tiff_file.write_word(value_count, fid, 4, False, self.little_endian)
+         data = tiff_file.pack_values(field_type, values, self.little_endian)
+         assert len(data) == self.field_size[field_type] * value_count
          # check if the value fits here or if we need offset
-         value_offset = None
-         if self.field_size[field_type] * value_count > 4:
+         if len(data) > 4:
             value_offset = free_ptr
-            tiff_file.write_word(value_offset, fid, 4, False, self.little_endian)
-            fid.seek(value_offset)
-            free_ptr = tiff_file.align(free_ptr + self.field_size[field_type] * value_count)
+            buf[value_offset:value_offset+len(data)] = data
+            free_ptr = tiff_file.align(free_ptr + len(data))
             # TODO: Update record with new value_offset
-         # write value(s)
-         if field_type == 1: # BYTE
-            for value in values:
-               tiff_file.write_word(value, fid, 1, False, self.little_endian)
-         elif field_type == 2: # ASCII
-            fid.write(values)
-         elif field_type == 3: # SHORT
-            for value in values:
-               tiff_file.write_word(value, fid, 2, False, self.little_endian)
-         elif field_type == 4: # LONG
-            for value in values:
-               tiff_file.write_word(value, fid, 4, False, self.little_endian)
-         elif field_type == 5: # RATIONAL
-            for value in values:
-               tiff_file.write_word(value[0], fid, 4, False, self.little_endian)
-               tiff_file.write_word(value[1], fid, 4, False, self.little_endian)
-         elif field_type == 6: # SBYTE
-            for value in values:
-               tiff_file.write_word(value, fid, 1, True, self.little_endian)
-         elif field_type == 7: # UNDEFINED
-            for value in values:
-               tiff_file.write_word(value, fid, 1, False, self.little_endian)
-         elif field_type == 8: # SSHORT
-            for value in values:
-               tiff_file.write_word(value, fid, 2, True, self.little_endian)
-         elif field_type == 9: # SLONG
-            for value in values:
-               tiff_file.write_word(value, fid, 4, True, self.little_endian)
-         elif field_type == 10: # SRATIONAL
-            for value in values:
-               tiff_file.write_word(value[0], fid, 4, True, self.little_endian)
-               tiff_file.write_word(value[1], fid, 4, True, self.little_endian)
-         elif field_type == 11: # FLOAT
-            for value in values:
-               tiff_file.write_float(value, fid, 4, self.little_endian)
-         elif field_type == 12: # DOUBLE
-            for value in values:
-               tiff_file.write_float(value, fid, 8, self.little_endian)
+            data = tiff_file.long_struct[order].pack(value_offset)
+         # write IFD entry information (with value or offset)
+         entry.pack_into(buf, ifd_offset + 2 + i*12, tag, field_type, value_count, data)
       # return updated pointers
       return offset_ptr, free_ptr
 
    # write data to stream
+   # (the file is written sequentially, so the stream does not need to be seekable)
    def write(self, fid):
-      # write TIFF header (and CR2 header if necessary)
-      ifd_ptr, offset_ptr = self.write_tiff_header(fid)
-      ifd_ptr, cr2_offset_ptr = self.write_cr2_header(fid, ifd_ptr)
-      # determine start of data space
-      data_ptr = ifd_ptr
+      order = tiff_file.get_byte_order(self.little_endian)
+      # determine space needed for headers and directories
+      data_ptr = 8
+      if self.cr2:
+         data_ptr += 8
       for k, (IFD, ifd_offset, strips) in enumerate(self.data):
          data_ptr += self.get_directory_length(IFD)
       # keep track of start of data space to check for overlaps later
       start_data_ptr = data_ptr
-      # write all IFDs and associated strips in file
+      # set up buffer for headers and directories
+      buf = bytearray(start_data_ptr)
+      # write TIFF header (and CR2 header if necessary)
+      ifd_ptr, offset_ptr = self.write_tiff_header(buf)
+      ifd_ptr, cr2_offset_ptr = self.write_cr2_header(buf, ifd_ptr)
+      # determine location of all data strips
+      layout = []
       for k, (IFD, ifd_offset, strips) in enumerate(self.data):
-         # write data strips if present
          if strips:
             tag_offset, tag_length = tiff_file.get_strip_parameters(IFD)
             assert len(IFD[tag_offset][2]) == len(strips)
@@ -700,28 +1076,143 @@ class tiff_file():
                # check and update IFD data
                assert IFD[tag_length][2][i] == len(strip)
                IFD[tag_offset][2][i] = data_ptr
-               # write data to file
-               fid.seek(data_ptr)
-               fid.write(strip)
+               layout.append((data_ptr, strip))
                # update free pointer
                data_ptr = tiff_file.align(data_ptr + len(strip))
+      # write all IFDs in buffer
+      cr2_ifd_offset = None
+      for k, (IFD, ifd_offset, strips) in enumerate(self.data):
          # if this was the CR2 IFD, write its offset in header
          if self.cr2 and ifd_offset == self.cr2_ifd_offset:
             print "Writing offset to IFD#%d = %d (0x%08x) as CR2" % (k, ifd_ptr, ifd_ptr)
-            self.cr2_ifd_offset = ifd_ptr
+            cr2_ifd_offset = ifd_ptr
             assert cr2_offset_ptr == 12
-            fid.seek(cr2_offset_ptr)
-            tiff_file.write_word(self.cr2_ifd_offset, fid, 4, False, self.little_endian)
+            tiff_file.long_struct[order].pack_into(buf, cr2_offset_ptr, cr2_ifd_offset)
          # write offset to this IFD
-         fid.seek(offset_ptr)
-         tiff_file.write_word(ifd_ptr, fid, 4, False, self.little_endian)
+         tiff_file.long_struct[order].pack_into(buf, offset_ptr, ifd_ptr)
          # write TIFF directory
-         offset_ptr, ifd_ptr = self.write_directory(IFD, fid, ifd_ptr)
-      # write null offset to IFD
-      fid.seek(offset_ptr)
-      tiff_file.write_word(0, fid, 4, False, self.little_endian)
+         offset_ptr, ifd_ptr = self.write_directory(IFD, buf, ifd_ptr)
+      # update CR2 IFD offset
+      if cr2_ifd_offset is not None:
+         self.cr2_ifd_offset = cr2_ifd_offset
+      # null offset to next IFD is already in place
       # check for overlap of IFD into data space
       assert ifd_ptr <= start_data_ptr
+      # write headers and directories, followed by data strips, in sequence
+      fid.write(buf)
+      write_ptr = start_data_ptr
+      for strip_ptr, strip in layout:
+         fid.write('\0' * (strip_ptr - write_ptr))
+         tiff_file.write_strip(fid, strip)
+         write_ptr = strip_ptr + len(strip)
+      return
+
+   # write data to named file, through a temporary file in the same folder
+   # that replaces it when complete (data strips may be views of a mapped
+   # input file, which must not be truncated before they are written, even if
+   # it is the file being replaced)
+   def write_file(self, filename):
+      folder = os.path.dirname(os.path.abspath(filename))
+      fid, tmpfile = tempfile.mkstemp(suffix='.tmp', dir=folder)
+      try:
+         with os.fdopen(fid, 'wb') as f:
+            self.write(f)
+         # keep permissions of file replaced, or use the usual default
+         if os.path.exists(filename):
+            shutil.copymode(filename, tmpfile)
+         else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpfile, 0666 & ~umask)
+         os.rename(tmpfile, filename)
+      except:
+         os.remove(tmpfile)
+         raise
+      return
+
+   # write zeros over given range of stream
+   @staticmethod
+   def write_zeros(fid, offset, length, chunk_size=1<<20):
+      fid.seek(offset)
+      while length > 0:
+         n = min(length, chunk_size)
+         fid.write('\0' * n)
+         length -= n
+      return
+
+   # locate entry with given tag in TIFF directory stored in stream
+   def find_entry(self, fid, ifd_offset, tag):
+      order = tiff_file.get_byte_order(self.little_endian)
+      entry = tiff_file.entry_struct[order]
+      # read number of IFD entries and the entries themselves
+      fid.seek(ifd_offset)
+      entry_count = tiff_file.short_struct[order].unpack(fid.read(2))[0]
+      buf = fid.read(entry_count*12)
+      for i in range(entry_count):
+         if entry.unpack_from(buf, i*12)[0] == tag:
+            return ifd_offset + 2 + i*12
+      raise AssertionError("Tag %d not found in directory at %d" % (tag, ifd_offset))
+
+   # replace data strips for given IFD directly in stream (opened for update)
+   # (the data is written in place of the original strips if it fits within
+   # their extent, otherwise it is appended at the end of the file, so that
+   # any data not known to the parser is left alone; only the strip offset
+   # and length entries in the IFD are updated)
+   def patch_strips(self, fid, k, data):
+      order = tiff_file.get_byte_order(self.little_endian)
+      entry = tiff_file.entry_struct[order]
+      # get references to required IFD
+      IFD, ifd_offset, strips = self.data[k]
+      assert strips
+      tag_offset, tag_length = tiff_file.get_strip_parameters(IFD)
+      strip_offsets = IFD[tag_offset][2]
+      strip_lengths = IFD[tag_length][2]
+      # determine space used by other objects
+      used = value_range()
+      used.add_ranges(self.spans)
+      for strip_offset, strip_length in zip(strip_offsets, strip_lengths):
+         if strip_length > 0:
+            used.sub_range(strip_offset, strip_offset + strip_length - 1)
+      # determine space available in place of original strips, as the extent
+      # of strips following on from the first one (allowing for alignment
+      # padding between them), stopping short of the next object used
+      start = strip_offsets[0]
+      end = start
+      for strip_offset, strip_length in sorted(zip(strip_offsets, strip_lengths)):
+         if strip_offset < start:
+            continue
+         if strip_offset > tiff_file.align(end):
+            break
+         end = max(end, strip_offset + strip_length)
+      i = bisect.bisect_left(used.data, (start,))
+      if i < len(used.data):
+         end = min(end, used.data[i][0])
+      space = end - start
+      # erase original strips
+      for strip_offset, strip_length in zip(strip_offsets, strip_lengths):
+         tiff_file.write_zeros(fid, strip_offset, strip_length)
+      # write new data in place or at end of file, as necessary
+      if len(data) <= space:
+         print "IFD#%d: Patching data strip with length %d in place at %d" % (k, len(data), start)
+         new_offset = start
+      else:
+         fid.seek(0, 2)
+         new_offset = tiff_file.align(fid.tell())
+         print "IFD#%d: Appending data strip with length %d at %d" % (k, len(data), new_offset)
+         fid.write('\0' * (new_offset - fid.tell()))
+      fid.seek(new_offset)
+      tiff_file.write_strip(fid, data)
+      # update IFD entries in stream, as a single LONG value
+      for tag, value in [(tag_offset, new_offset), (tag_length, len(data))]:
+         fid.seek(self.find_entry(fid, ifd_offset, tag))
+         fid.write(entry.pack(tag, 4, 1, tiff_file.long_struct[order].pack(value)))
+         IFD[tag] = (4, 1, [value], None)
+      # update data strips and range of bytes used
+      del strips[:]
+      strips.append(data)
+      self.spans = used
+      if len(data) > 0:
+         self.spans.add_range(new_offset, new_offset + len(data) - 1)
       return
 
    # print formatted data to stream
@@ -795,6 +1286,7 @@ class tiff_file():
       return mmap
 
    # return memory map of all objects
+   # (use range_map on the result to look up objects by offset)
    def get_memorymap(self):
       # start with an empty memory map
       mmap = []
@@ -825,6 +1317,6 @@ class tiff_file():
          if strips:
             fid = open('%s-%d.dat' % (basename, k), 'w')
             for strip in strips:
-               fid.write(strip)
+               tiff_file.write_strip(fid, strip)
             fid.close()
       return
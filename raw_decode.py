@@ -36,34 +36,46 @@ def main():
    parser = argparse.ArgumentParser()
    parser.add_argument("-r", "--raw", required=True,
                      help="input RAW file for image parameters")
-   parser.add_argument("-i", "--input", required=True,
-                     help="input JPEG lossless raw data file to decode")
+   parser.add_argument("-i", "--input",
+                     help="input JPEG lossless raw data file to decode (default: RAW IFD of input RAW file)")
    parser.add_argument("-o", "--output", required=True,
                      help="output sensor image file (PGM)")
    parser.add_argument("-d", "--display", action="store_true", default=False,
                      help="display decoded image")
+   parser.add_argument("-R", "--roi", nargs=4, type=int, metavar=("X", "Y", "W", "H"),
+                     help="decode only the given region of the sensor image")
+   parser.add_argument("-j", "--jobs", type=int, default=1,
+                     help="number of processes to use for decoding (default: %(default)s)")
+   parser.add_argument("--no-cache", action="store_true", default=False,
+                     help="do not use or update the decoded sensor image cache")
+   parser.add_argument("-b", "--backend", choices=["native", "pvrg"], default="native",
+                     help="lossless JPEG codec to use (default: %(default)s)")
    args = parser.parse_args()
 
    # read input raw file
    tiff = jbtiff.tiff_file(open(args.raw, 'rb'))
 
-   # convert lossless JPEG encoded input file to raw data
-   a, components, precision = jbcr2.decode_lossless_jpeg(args.input)
-   # obtain required parameters from RAW file
-   width,height = tiff.get_sensor_size()
-   slices = tiff.get_slices()
-   # unslice image
-   I = jbcr2.unslice_image(a, width, height, slices)
+   if args.input:
+      # obtain required parameters from RAW file
+      width,height = tiff.get_sensor_size()
+      slices = tiff.get_slices()
+      # decode lossless JPEG encoded input file directly to sensor image
+      with open(args.input, 'rb') as fid:
+         I = jbcr2.decode_sensor_image(fid.read(), width, height, slices,
+            args.backend, args.roi, args.jobs, not args.no_cache)
+   else:
+      # decode RAW IFD data strip directly to sensor image
+      I = jbcr2.decode_raw_ifd(tiff, args.backend, args.roi, args.jobs, not args.no_cache)
 
    # save result
-   jbimage.pnm_file.write(I.astype('>H'), open(args.output,'wb'))
+   jbimage.pnm_file.write(I, open(args.output,'wb'))
 
    # show user what we've done, as needed
    if args.display:
       # linear display
       plt.figure()
       plt.imshow(I, cmap=plt.cm.gray)
-      plt.title('%s' % args.input)
+      plt.title('%s' % (args.input or args.raw))
       # show everything
       plt.show()
    return
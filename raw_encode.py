@@ -47,6 +47,8 @@ def main():
                      help="number of bits per sensor pixel")
    parser.add_argument("-d", "--display", action="store_true", default=False,
                      help="display encoded images")
+   parser.add_argument("-b", "--backend", choices=["native", "pvrg"], default="native",
+                     help="lossless JPEG codec to use (default: %(default)s)")
    args = parser.parse_args()
 
    # See raw_decode.py for color components & slicing example
@@ -63,14 +65,16 @@ def main():
    assert len(sensor.shape) == 2 # must be a one-channel image
    assert sensor.shape == (height,width) # image size must be exact
 
-   # slice image
-   a = jbcr2.slice_image(sensor, width, height, slices)
-   # encode to lossless JPEG output file
-   parts = jbcr2.encode_lossless_jpeg(a, args.components, args.precision, args.output)
+   # encode sensor image to lossless JPEG output file
+   data = jbcr2.encode_sensor_image(sensor, width, height, slices,
+      args.components, args.precision, args.backend)
+   with open(args.output, 'wb') as fid:
+      fid.write(data)
 
    # show user what we've done, as needed
    if args.display:
-      for i, b in enumerate(parts):
+      a = jbcr2.slice_image(sensor, width, height, slices)
+      for i, b in enumerate(jbcr2.split_components(a, args.components)):
          plt.figure()
          plt.imshow(b, cmap=plt.cm.gray)
          plt.title('Part %d' % i)
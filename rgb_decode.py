@@ -28,6 +28,7 @@ import matplotlib.pyplot as plt
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
 import jbtiff
 import jbimage
+import jbcolor
 
 ## main program
 
@@ -44,6 +45,10 @@ def main():
                      help="saturation level (overriding camera default)")
    parser.add_argument("-b", "--bayer", default="RGGB",
                      help="Bayer pattern (first letter pair for odd rows, second pair for even rows)")
+   parser.add_argument("-D", "--demosaic", choices=jbcolor.methods, default="nearest",
+                     help="demosaic method (default: %(default)s)")
+   parser.add_argument("-j", "--jobs", type=int,
+                     help="number of threads to use (default: one per processor)")
    parser.add_argument("-C", "--camera",
                      help="camera identifier string for color table lookup")
    parser.add_argument("-d", "--display", action="store_true", default=False,
@@ -65,7 +70,7 @@ def main():
    assert I.shape == (height,width) # image size must be exact
 
    # get necessary transformation data
-   t_black, t_maximum, cam_rgb = jbtiff.tiff_file.color_table[model]
+   t_black, t_maximum, cam_rgb, rgb_cam = jbtiff.tiff_file.get_color_profile(model)
    # extract references to color channels
    # c0 c1 / c2 c3 = R G / G B on most Canon cameras
    c = []
@@ -82,47 +87,20 @@ def main():
    if args.saturation:
       t_maximum = args.saturation
    print "Scaling with black levels (%s), saturation %d" % (','.join("%d" % x for x in bl),t_maximum)
-   for i in range(4):
-      c[i]  = (c[i]  - bl[i])/float(t_maximum - bl[i])
-   # determine nearest neighbour for each colour channel
-   assert len(args.bayer) == 4
-   nn = []
-   for ch,color in enumerate("RGB"):
-      ch_nn = np.zeros((2,2),dtype=int)
-      ch_nn[:] = -1 # initialize
-      if args.bayer.count(color) == 1: # there is only one instance
-         ch_nn[:] = args.bayer.find(color)
-      elif args.bayer.count(color) == 2: # there are two instances
-         ch_nn[0,:] = args.bayer.find(color,0,2)
-         ch_nn[1,:] = args.bayer.find(color,2,4)
-      assert(ch_nn.min() >= 0)
-      nn.append(ch_nn)
-   # copy color channels and interpolate missing data (nearest neighbour)
-   I = np.zeros((height, width, 3))
-   for ch in range(3):
-      for i in [0,1]:
-         for j in [0,1]:
-            I[i::2,j::2,ch] = c[nn[ch][i,j]]
-   # convert from camera color space to linear RGB D65 space
-   rgb_cam = np.linalg.pinv(cam_rgb)
-   I = np.dot(I, rgb_cam.transpose())
-   # limit values
-   np.clip(I, 0.0, 1.0, I)
-   # apply sRGB gamma correction
-   I = jbtiff.tiff_file.srgb_gamma(I)
-   # cut border
+   # demosaic, convert to sRGB and scale to 16-bit, tile by tile, for the
+   # image area within the border only
    x1,y1,x2,y2 = border
-   I = I[y1:y2+1,x1:x2+1]
+   region = (x1, y1, x2-x1+1, y2-y1+1)
+   I = jbcolor.sensor_to_srgb(I, bl, t_maximum, args.bayer, args.demosaic, rgb_cam,
+      np.empty((y2-y1+1, x2-x1+1, 3), dtype=np.dtype('>H')), region, threads=args.jobs)
    # show colour image, as needed
    if args.display:
       plt.figure()
-      plt.imshow(I.astype('float'))
+      plt.imshow(I / float((1<<16)-1))
       plt.title('%s' % args.input)
-   # scale to 16-bit
-   I *= (1<<16)-1
 
    # save result
-   jbimage.pnm_file.write(I.astype('>H'), open(args.output,'wb'))
+   jbimage.pnm_file.write(I, open(args.output,'wb'))
 
    # show user what we've done, as needed
    if args.display:
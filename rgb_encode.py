@@ -28,6 +28,7 @@ import matplotlib.pyplot as plt
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pyshared'))
 import jbtiff
 import jbimage
+import jbcolor
 
 ## main program
 
@@ -74,27 +75,24 @@ def main():
    assert len(I.shape) == 3 and I.shape[2] == 3 # must be a three-channel image
    assert I.shape == (iheight,iwidth,3) # image size must be exact
 
-   # scale each channel to [0.0,1.0]
+   # determine input depth
    if I.dtype == np.dtype('uint8'):
       depth = 8
    elif I.dtype == np.dtype('>H'):
       depth = 16
    else:
       raise ValueError("Cannot handle input arrays of type %s" % I.dtype)
-   I = I / float((1<<depth)-1)
-   # invert sRGB gamma correction
-   I = jbtiff.tiff_file.srgb_gamma_inverse(I)
+   # invert sRGB gamma correction, scaling each channel to [0.0,1.0]
+   I = jbtiff.tiff_file.srgb_gamma_inverse_lookup(I, depth, np.float32)
    # get necessary transformation data
-   t_black, t_maximum, cam_rgb = jbtiff.tiff_file.color_table[model]
-   # convert from linear RGB D65 space to camera color space
-   I = np.dot(I, cam_rgb.transpose())
-   # limit values
-   np.clip(I, 0.0, 1.0, I)
-   # add black level and scale each channel to saturation limit
+   t_black, t_maximum, cam_rgb, rgb_cam = jbtiff.tiff_file.get_color_profile(model)
    if args.saturation:
       t_maximum = args.saturation
    print "Scaling with black level %d, saturation %d" % (args.black,t_maximum)
-   I = I * (t_maximum - args.black) + args.black
+   # affine transform from linear RGB D65 space to camera color space,
+   # scaling each channel to saturation limit and adding black level
+   A = cam_rgb * (t_maximum - args.black)
+   limits = (args.black, args.black, t_maximum)
 
    # determine subsampling rate
    step = int(round(height / float(sheight)))
@@ -108,7 +106,7 @@ def main():
       raise ValueError("Cannot handle raw images of depth %d" % sdepth)
    # create small RGB image and copy color channels
    a = np.zeros((iheight//step, iwidth//step, 3), dtype=dtype)
-   a[:] = I[0::step,0::step,:]
+   a[:] = jbcolor.color_transform(I[0::step,0::step,:], A, *limits)
    # add border
    dy1 = (sheight - a.shape[0])//2
    dy2 = sheight - a.shape[0] - dy1
@@ -119,22 +117,20 @@ def main():
    # save result
    a.tofile(open(args.small,'w'))
 
-   # add border
-   dy1 = y1
-   dy2 = height-y2-1
-   dx1 = x1
-   dx2 = width-x2-1
-   I = np.pad(I, ((dy1,dy2),(dx1,dx2),(0,0)), mode='constant', constant_values=args.black).astype('>H')
-   assert I.shape == (height, width, 3)
-   # determine mapping for each colour channel
-   assert len(args.bayer) == 4
-   cmap = {v: k for k, v in enumerate("RGB")}
-   # create full sensor image and copy color channels
-   a = np.zeros((height,width), dtype=np.dtype('>H'))
-   a[0::2,0::2] = I[0::2,0::2,cmap[args.bayer[0]]]
-   a[0::2,1::2] = I[0::2,1::2,cmap[args.bayer[1]]]
-   a[1::2,0::2] = I[1::2,0::2,cmap[args.bayer[2]]]
-   a[1::2,1::2] = I[1::2,1::2,cmap[args.bayer[3]]]
+   # create full sensor image, with border at black level
+   a = np.empty((height,width), dtype=np.dtype('>H'))
+   a[:] = args.black
+   # determine colour channel at each Bayer position
+   m = jbcolor.get_bayer_map(args.bayer)
+   # fill in active area, computing only the colour channel needed at each
+   # site (Bayer positions are relative to the full sensor)
+   for i in [0,1]:
+      for j in [0,1]:
+         ys = y1 + (i - y1) % 2
+         xs = x1 + (j - x1) % 2
+         ch = m[i][j]
+         a[ys:y2+1:2,xs:x2+1:2] = jbcolor.color_transform( \
+            I[ys-y1::2,xs-x1::2,:], A[ch:ch+1], *limits)[:,:,0]
    # save result
    jbimage.pnm_file.write(a, open(args.output,'w'))
 